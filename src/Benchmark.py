@@ -0,0 +1,345 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#This file is part of Thekla.
+
+"""
+Benchmarks the stages of thekla on synthetic data of a given size: a topic
+model in the format of lda-c, a vocabulary and a corpus of documents are
+generated (see generate_data) and the topic model is loaded, the documents
+are represented, clustered and visualized while time, memory and throughput
+are measured with Profile (see run_benchmark). Results are written as JSON
+and can be compared with the results of another version.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import optparse
+import os
+import shutil
+import string
+import tempfile
+import time
+
+import numpy as np
+
+from TopicModel import TopicModel as TM
+from Document import Documents as DOCS
+import Clustering
+import Profile
+import Visualize
+import thekla
+
+#the parameters of the synthetic data
+DATA_PARAMETERS = ('topics', 'words', 'docs', 'tokens', 'unknown', 'seed')
+
+#number of words written per line of a document
+LINE_WORDS = 12
+
+
+def generate_words(n_words, rng):
+    """
+    Returns /n_words/ distinct lowercase words in random order: a random
+    prefix of 2 to 7 letters followed by the word's index in base 26, which
+    keeps them distinct and grows with /n_words/.
+    """
+    letters = np.array(list(string.ascii_lowercase))
+    lengths = rng.randint(2, 8, n_words)
+    prefixes = letters[rng.randint(0, 26, lengths.sum())]
+    words = []
+    start = 0
+    for index, length in enumerate(lengths):
+        suffix = ''
+        while True:
+            index, digit = divmod(index, 26)
+            suffix += letters[digit]
+            if index == 0:
+                break
+        words.append(''.join(prefixes[start:start + length]) + suffix)
+        start += length
+    return words
+
+
+def generate_topics(n_topics, n_words, rng, concentration=0.1):
+    """
+    Returns a /n_topics/ x /n_words/ matrix of log word probabilities like
+    the ones in the beta file of lda-c. The topics are drawn from a sparse
+    Dirichlet distribution with /concentration/.
+    """
+    topics = rng.gamma(concentration, size=(n_topics, n_words))
+    topics /= topics.sum(axis=1)[:, np.newaxis]
+    return np.log(np.maximum(topics, 1e-300))
+
+
+def generate_documents(doc_dir, words, topics, n_docs, tokens, unknown, rng):
+    """
+    Writes /n_docs/ documents to /doc_dir/. Each document has about
+    /tokens/ words drawn from one or two of the /topics/; the fraction
+    /unknown/ of them is not in the vocabulary.
+    """
+    words = np.array(words, dtype=object)
+    #cumulative word distribution of each topic to draw words with a binary
+    #search, drawing with the full distribution costs the vocabulary size
+    cdfs = np.exp(topics).cumsum(axis=1)
+    cdfs /= cdfs[:, -1:]
+    n_topics = len(topics)
+    for doc in xrange(n_docs):
+        n_tokens = max(1, rng.poisson(tokens))
+        doc_topics = rng.randint(0, n_topics, 2)
+        first = int(rng.binomial(n_tokens, 0.8))
+        ids = np.concatenate((
+            np.searchsorted(cdfs[doc_topics[0]], rng.random_sample(first)),
+            np.searchsorted(cdfs[doc_topics[1]],
+                rng.random_sample(n_tokens - first))))
+        ids = np.minimum(ids, len(words) - 1)
+        doc_words = words[ids]
+        #unknown words contain digits, the vocabulary does not
+        is_unknown = rng.random_sample(n_tokens) < unknown
+        doc_words[is_unknown] = ['{0}{1}'.format(word, number) for word, number
+                in zip(doc_words[is_unknown], rng.randint(0, 100,
+                    is_unknown.sum()))]
+        lines = [' '.join(doc_words[start:start + LINE_WORDS])
+                for start in xrange(0, n_tokens, LINE_WORDS)]
+        fname = os.path.join(doc_dir, 'doc_{0:07d}.txt'.format(doc))
+        with io.open(fname, 'w', encoding='utf-8') as dfile:
+            dfile.write('\n'.join(lines) + '\n')
+
+
+def generate_data(data_dir, parameters):
+    """
+    Generates the files described by /parameters/ (see DATA_PARAMETERS) in
+    /data_dir/ and returns the names of the vocabulary file, the beta file
+    and the document directory. Data generated with the same parameters
+    before is reused, so different versions are compared on the same data.
+    """
+    vocab_file = os.path.join(data_dir, 'synthetic.vocab')
+    beta_file = os.path.join(data_dir, 'synthetic.beta')
+    doc_dir = os.path.join(data_dir, 'docs')
+    parameter_file = os.path.join(data_dir, 'parameters.json')
+    files = (vocab_file, beta_file, doc_dir)
+    try:
+        with open(parameter_file, 'r') as pfile:
+            if json.load(pfile) == parameters:
+                logging.info('reusing synthetic data in "{dir}"'.format(
+                    dir=data_dir))
+                return files
+    except (IOError, ValueError):
+        pass
+
+    logging.info('generating {docs} documents and a model with {topics} '
+            'topics and {words} words in "{dir}"..'.format(dir=data_dir,
+                **parameters))
+    start = time.time()
+    for path in (parameter_file, doc_dir):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    #remove caches of a previous model
+    for fname in os.listdir(data_dir):
+        if fname.startswith(('synthetic.vocab.', 'synthetic.beta.')):
+            os.remove(os.path.join(data_dir, fname))
+    os.makedirs(doc_dir)
+
+    rng = np.random.RandomState(parameters['seed'])
+    words = generate_words(parameters['words'], rng)
+    with io.open(vocab_file, 'w', encoding='utf-8') as vfile:
+        vfile.write('\n'.join(words) + '\n')
+    topics = generate_topics(parameters['topics'], parameters['words'], rng)
+    np.savetxt(beta_file, topics, fmt=str(' %5.10f'), delimiter=str(''))
+    generate_documents(doc_dir, words, topics, parameters['docs'],
+            parameters['tokens'], parameters['unknown'], rng)
+
+    with open(parameter_file, 'w') as pfile:
+        json.dump(parameters, pfile)
+    logging.info('done in {time:.1f}s'.format(time=time.time() - start))
+    return files
+
+
+def throughput(report):
+    """Adds the counts per second of wall time to each stage in /report/."""
+    for stage in report['stages']:
+        stage['per_second'] = dict((key, value / stage['wall'])
+                for key, value in stage['counts'].iteritems()
+                if stage['wall'] > 0)
+    return report
+
+
+def run_benchmark(data_dir, parameters, workers=1,
+        cluster_algorithm='kmeans', cluster_options=None,
+        cluster_space='centroids', centroid_computation='avg'):
+    """
+    Generates the data (see generate_data) and measures each stage of thekla
+    on it. Returns the Profile of the stages.
+    """
+    vocab_file, beta_file, doc_dir = generate_data(data_dir, parameters)
+    if cluster_options is None:
+        cluster_options = {'n_clusters': 8, 'random_state': 0}
+    stages = Profile.Profile('benchmark')
+
+    with stages.stage('load_topic_model') as counts:
+        tm = TM(vocab_file, beta_file, cache=False)
+        counts.update(words=len(tm.vocab), topics=len(tm))
+    #the first load with the cache writes it
+    TM(vocab_file, beta_file, cache=True)
+    with stages.stage('load_topic_model_cached') as counts:
+        tm = TM(vocab_file, beta_file, cache=True)
+        counts.update(words=len(tm.vocab), topics=len(tm))
+
+    with stages.stage('represent_documents') as counts:
+        #a directory is given as a byte string like in a config
+        documents = DOCS(str(doc_dir), tm, centroid_computation, workers)
+        counts.update(documents.counts, documents=len(documents))
+
+    with stages.stage('create_clusters') as counts:
+        clusters = Clustering.create_clusters(documents, cluster_algorithm,
+                cluster_options, cluster_space)
+        counts.update(documents=len(documents), clusters=len(clusters))
+
+    #the default of thekla if no cluster options are given
+    with stages.stage('create_clusters_dbscan_infer') as counts:
+        dbscan_clusters = Clustering.create_clusters_dbscan_infer_options(
+                documents, cluster_space=cluster_space)
+        counts.update(documents=len(documents), clusters=len(dbscan_clusters))
+
+    with stages.stage('create_cluster_centroids') as counts:
+        cluster_centroids = thekla.create_cluster_centroids(clusters,
+                documents)
+        counts.update(clusters=len(clusters))
+
+    axis_labels = thekla.get_axis_labels(tm)
+    for fmt in ('png', 'svg', 'json'):
+        stage = 'render_radar_chart'
+        if fmt != 'png':
+            stage += '_' + fmt
+        with stages.stage(stage) as counts:
+            if cluster_centroids:
+                Visualize.save_radar_chart('benchmark', cluster_centroids,
+                        axis_labels,
+                        fname=os.path.join(data_dir, 'benchmark.' + fmt))
+                counts.update(charts=1)
+
+    return stages
+
+
+def compare(report, previous):
+    """
+    Returns a table comparing the wall time and peak memory of each stage in
+    /report/ with the stages in the /previous/ report.
+    """
+    previous_stages = dict((stage['stage'], stage)
+            for stage in previous['stages'])
+    lines = ['{0:<28} {1:>9} {2:>9} {3:>7} {4:>10} {5:>10}'.format('stage',
+        'wall[s]', 'before', 'ratio', 'peak[MB]', 'before')]
+    for stage in report['stages'] + [dict(report['total'], stage='total')]:
+        before = previous_stages.get(stage['stage'])
+        if stage['stage'] == 'total':
+            before = previous['total']
+        if before is None:
+            continue
+        ratio = stage['wall'] / before['wall'] if before['wall'] else float('nan')
+        lines.append('{0:<28} {1:>9.3f} {2:>9.3f} {3:>7.2f} {4:>10} {5:>10}'.format(
+            stage['stage'], stage['wall'], before['wall'], ratio,
+            _format_mb(stage['peak_rss_mb']), _format_mb(before['peak_rss_mb'])))
+    return '\n'.join(lines)
+
+
+def _format_mb(value):
+    return '-' if value is None else '{0:.1f}'.format(value)
+
+
+def init_optionparser():
+    """Initialise command line parser."""
+
+    usage = 'Usage: %prog [options]'
+
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option('--topics', type='int', default=50,
+        help='Number of topics of the model [default: %default]')
+    parser.add_option('--words', type='int', default=20000,
+        help='Number of words in the vocabulary [default: %default]')
+    parser.add_option('--docs', type='int', default=5000,
+        help='Number of documents [default: %default]')
+    parser.add_option('--tokens', type='int', default=200,
+        help='Average number of words per document [default: %default]')
+    parser.add_option('--unknown', type='float', default=0.05,
+        help='Fraction of words that are not in the vocabulary '
+        '[default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+        help='Seed of the synthetic data [default: %default]')
+    parser.add_option('--data', dest='data_dir', metavar='DIR',
+        help='Keep the synthetic data in DIR and reuse it in later runs '
+        '[default: a temporary directory]')
+    parser.add_option('-w', '--workers', type='int', default=1,
+        help='Number of processes representing the documents '
+        '[default: %default]')
+    parser.add_option('--cluster-algorithm', default='kmeans',
+        choices=['dbscan', 'kmeans', 'minibatch_kmeans'], type='choice',
+        help='Algorithm used to cluster the documents [default: %default]')
+    parser.add_option('--cluster-options', default=None,
+        help='Options of the cluster algorithm as a JSON dictionary '
+        '[default: {"n_clusters": 8, "random_state": 0}]')
+    parser.add_option('--cluster-space', default='centroids',
+        choices=list(Clustering.CLUSTER_SPACES), type='choice',
+        help='Space the documents are clustered in [default: %default]')
+    parser.add_option('-o', '--output', metavar='FILE',
+        help='Write the results as JSON to FILE')
+    parser.add_option('--label', default=thekla.__version__,
+        help='Label of the results, e.g. the version [default: %default]')
+    parser.add_option('--compare', metavar='FILE',
+        help='Compare with the results in FILE written by --output')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = init_optionparser()
+    (options, args) = parser.parse_args()
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.formatter = logging.Formatter('[%(levelname)s]: %(message)s')
+    logging.getLogger().addHandler(console)
+
+    parameters = dict((name, getattr(options, name))
+            for name in DATA_PARAMETERS)
+    cluster_options = None
+    if options.cluster_options:
+        cluster_options = json.loads(options.cluster_options)
+    data_dir = options.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='thekla_benchmark_')
+    elif not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    try:
+        stages = run_benchmark(data_dir, parameters, options.workers,
+                options.cluster_algorithm, cluster_options,
+                options.cluster_space)
+    finally:
+        if options.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    report = throughput(stages.report())
+    result = {'label': options.label, 'parameters': parameters,
+            'workers': options.workers,
+            'cluster_algorithm': options.cluster_algorithm,
+            'cluster_space': options.cluster_space, 'report': report}
+    print(stages.summary())
+    for stage in report['stages']:
+        print('{0:<28} {1}'.format(stage['stage'], ', '.join(
+            '{0}={1:.1f}/s'.format(key, value)
+            for key, value in sorted(stage['per_second'].iteritems()))))
+    if options.compare:
+        with open(options.compare, 'r') as cfile:
+            previous = json.load(cfile)
+        if previous['parameters'] != parameters:
+            logging.warning('{file} was measured on other data: {params}'.format(
+                file=options.compare, params=previous['parameters']))
+        print('compared with {label}:'.format(label=previous['label']))
+        print(compare(report, previous['report']))
+    if options.output:
+        with open(options.output, 'w') as ofile:
+            json.dump(result, ofile, indent=2, sort_keys=True)
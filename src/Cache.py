@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+
+#This file is part of Thekla.
+
+"""
+Helpers for the binary sidecar files thekla writes next to its input files.
+
+A cached array is stored as a .npy file together with a small .json file
+holding the key of the source file it was created from (size and mtime). The
+cache is only used as long as the key still matches the source file.
+
+Large arrays can also be filled in place on disk, see create_array.
+
+Document centroids are cached in an sqlite database, see CentroidCache.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+
+def source_key(fname, **extra):
+    """
+    Returns a dictionary identifying the current state of file /fname/.
+    Additional keyword arguments are added to the key, e.g. the dtype.
+    """
+    stat = os.stat(fname)
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    key.update(extra)
+    return key
+
+
+def fingerprint(*fnames, **extra):
+    """
+    Returns a string identifying the current state of the files /fnames/ and
+    the additional keyword arguments.
+    """
+    keys = [(os.path.abspath(fname), source_key(fname)) for fname in fnames]
+    keys.append(extra)
+    return hashlib.sha1(json.dumps(keys, sort_keys=True)).hexdigest()
+
+
+def _key_file(cache_file):
+    return cache_file + '.json'
+
+
+def load_array(cache_file, key, mmap_mode='r'):
+    """
+    Returns the array stored in /cache_file/ if the stored key equals /key/,
+    otherwise None. By default the array is memory-mapped read-only.
+    """
+    try:
+        with open(_key_file(cache_file), 'r') as kfile:
+            cached_key = json.load(kfile)
+    except (IOError, ValueError):
+        return None
+    if cached_key != key:
+        logging.debug('cache "{cache}" is stale'.format(cache=cache_file))
+        return None
+    try:
+        array = np.load(cache_file, mmap_mode=mmap_mode)
+    except (IOError, ValueError) as e:
+        logging.warning('could not read cache "{cache}": {err}'.format(
+            cache=cache_file, err=e))
+        return None
+    #a plain ndarray view on the mapping avoids the overhead np.memmap adds
+    #to every operation
+    return np.asarray(array)
+
+
+def save_array(cache_file, key, array):
+    """
+    Writes /array/ to /cache_file/ together with /key/. Returns False if the
+    cache could not be written, e.g. because the directory is read-only.
+    """
+    tmp_file = cache_file + '.tmp'
+    try:
+        #np.save appends .npy to names without that suffix
+        with open(tmp_file, 'wb') as cfile:
+            np.save(cfile, array)
+        os.rename(tmp_file, cache_file)
+        with open(_key_file(cache_file), 'w') as kfile:
+            json.dump(key, kfile)
+    except (IOError, OSError) as e:
+        logging.warning('could not write cache "{cache}": {err}'.format(
+            cache=cache_file, err=e))
+        return False
+    return True
+
+
+#number of lines commit_array copies at once
+COPY_ROWS = 1 << 14
+
+def create_array(cache_file, shape, dtype=np.float64):
+    """
+    Returns a new array of /shape/ that is memory-mapped from a temporary
+    file next to /cache_file/, so it can be filled without holding it in
+    memory. The filled array is stored with commit_array.
+    """
+    if os.path.exists(_key_file(cache_file)):
+        #the old cache is invalid from now on
+        os.remove(_key_file(cache_file))
+    return np.lib.format.open_memmap(cache_file + '.tmp', mode='w+',
+            dtype=dtype, shape=shape)
+
+
+def commit_array(cache_file, key, array, rows=None):
+    """
+    Stores the /array/ created by create_array as /cache_file/ together with
+    /key/. If /rows/ is given, only the first /rows/ lines are kept. Returns
+    False if the cache could not be written.
+    """
+    tmp_file = cache_file + '.tmp'
+    try:
+        array.flush()
+        if rows is not None and rows < len(array):
+            #copy the used lines to a file of the right shape block by block
+            part_file = cache_file + '.part'
+            part = np.lib.format.open_memmap(part_file, mode='w+',
+                    dtype=array.dtype, shape=(rows,) + array.shape[1:])
+            for start in range(0, rows, COPY_ROWS):
+                end = min(rows, start + COPY_ROWS)
+                part[start:end] = array[start:end]
+            part.flush()
+            del part
+            os.remove(tmp_file)
+            tmp_file = part_file
+        os.rename(tmp_file, cache_file)
+        with open(_key_file(cache_file), 'w') as kfile:
+            json.dump(key, kfile)
+    except (IOError, OSError) as e:
+        logging.warning('could not write cache "{cache}": {err}'.format(
+            cache=cache_file, err=e))
+        return False
+    return True
+
+
+def _path_text(fname):
+    """
+    Returns the path /fname/ as unicode, sqlite only binds text. Byte strings
+    are decoded as utf-8, None is returned if that fails.
+    """
+    if isinstance(fname, unicode):
+        return fname
+    try:
+        return fname.decode('utf-8')
+    except UnicodeDecodeError:
+        logging.debug('not caching "{path}", it is not utf-8'.format(
+            path=repr(fname)))
+        return None
+
+
+class CentroidCache:
+    """
+    Persistent store of document centroids. A centroid is valid as long as
+    the document has the same size and mtime and was computed with the same
+    topic model (see TopicModel.fingerprint) and centroid flavor.
+    """
+
+    #number of paths per query, sqlite limits the number of parameters
+    CHUNK_SIZE = 500
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        #wait for concurrent writers instead of failing
+        self.db = sqlite3.connect(db_file, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS centroids ('
+                'path TEXT, model TEXT, flavor TEXT, size INTEGER, '
+                'mtime REAL, centroid BLOB, '
+                'PRIMARY KEY (path, model, flavor))')
+        self.db.commit()
+
+
+    def close(self):
+        self.db.close()
+
+
+    def lookup(self, fnames, model, flavor):
+        """
+        Returns a dictionary {fname : centroid} of the valid cache entries
+        for /fnames/. The centroid of a document without any known word is
+        None.
+        """
+        res = {}
+        for start in range(0, len(fnames), self.CHUNK_SIZE):
+            #the paths are stored as text, the result uses the given ones
+            chunk = dict((_path_text(fname), fname)
+                    for fname in fnames[start:start+self.CHUNK_SIZE])
+            chunk.pop(None, None)
+            if not chunk:
+                continue
+            query = ('SELECT path, size, mtime, centroid FROM centroids '
+                    'WHERE model = ? AND flavor = ? AND path IN ({params})'.format(
+                        params=', '.join('?' * len(chunk))))
+            for path, size, mtime, centroid in self.db.execute(query,
+                    [model, flavor] + list(chunk)):
+                fname = chunk[path]
+                try:
+                    if source_key(fname) != {'size': size, 'mtime': mtime}:
+                        continue
+                except OSError:
+                    continue
+                if centroid is not None:
+                    centroid = np.frombuffer(centroid, dtype=np.float64)
+                res[fname] = centroid
+        return res
+
+
+    def store(self, fnames, centroids, represented, model, flavor):
+        """
+        Stores the centroids of /fnames/ (one line of /centroids/ per file).
+        Files that are not /represented/ are stored without a centroid.
+        """
+        rows = []
+        for fname, centroid, is_repr in zip(fnames, centroids, represented):
+            path = _path_text(fname)
+            if path is None:
+                continue
+            key = source_key(fname)
+            blob = None
+            if is_repr:
+                blob = sqlite3.Binary(
+                        np.asarray(centroid, dtype=np.float64).tostring())
+            rows.append((path, model, flavor, key['size'], key['mtime'], blob))
+        self.db.executemany('INSERT OR REPLACE INTO centroids VALUES '
+                '(?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
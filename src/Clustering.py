@@ -5,6 +5,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import logging
+import re
 import numpy as np
 import scipy
 
@@ -13,63 +14,281 @@ import scipy
 from scipy.spatial import distance
 from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.neighbors import BallTree
 from sklearn import metrics
 
-def create_clusters(documents, cluster_algorithm, cluster_options):
+#The spaces documents can be clustered in:
+#distances - each document is represented by its distances to all other
+#   documents. Needs a N x N matrix for N documents.
+#centroids - the documents' centroids are clustered directly. DBSCAN uses a
+#   ball tree then, memory grows with the number of neighbors instead of N^2.
+CLUSTER_SPACES = ('distances', 'centroids')
+
+#statistics of the distances dbscan's eps can be inferred from: the mean or
+#   median of all pairwise distances, or the distance of the documents to
+#   their minsample-th nearest neighbor
+EPS_STATISTICS = ('mean', 'median', 'knn')
+
+#eps is this multiple of the mean or median distance
+EPS_FACTORS = {'mean': 4, 'median': 5}
+
+#algorithms that always cluster in the centroids space
+CENTROID_ALGORITHMS = (MiniBatchKMeans,)
+
+def create_clusters(documents, cluster_algorithm, cluster_options,
+        cluster_space='distances', clusterer=None):
     """
-    Clusters the /documents/ using /cluster_algorithm/ with /cluster_options/.
+    Clusters the /documents/ using /cluster_algorithm/ with /cluster_options/
+    in /cluster_space/ (see CLUSTER_SPACES). For minibatch_kmeans a
+    StreamingKMeans /clusterer/ that was updated while the documents were
+    represented can be given; it is only used to assign the documents then.
     """
-    algorithms = {'kmeans':KMeans, 'dbscan':DBSCAN}
+    algorithms = {'kmeans':KMeans, 'dbscan':DBSCAN,
+            'minibatch_kmeans':MiniBatchKMeans}
     if cluster_algorithm not in algorithms.keys():
         logging.error('Cluster algorithm "{alg}" unknown! Won\'t cluster.'.format(
-            cluster_algorithm))
+            alg=cluster_algorithm))
+        return {}
 
     doc_matrix, doc_list = documents.as_centroid_matrix()
     
     cluster_alg = algorithms[cluster_algorithm]
-    cluster_res = perform_clustering(cluster_alg, doc_matrix, cluster_options)
+    if clusterer is not None and cluster_alg is MiniBatchKMeans:
+        logging.info('Cluster algorithm is {alg}; options are {options}'.format(
+            alg=cluster_alg.__name__, options=cluster_options))
+        cluster_res = clusterer.assign(doc_matrix)
+    else:
+        cluster_res = perform_clustering(cluster_alg, doc_matrix,
+                cluster_options, cluster_space)
     clusters = process_clustering(cluster_res, doc_list, documents)
     return clusters
 
 
-def create_clusters_dbscan_infer_options(documents, X=1):
+def create_clusters_dbscan_infer_options(documents, X=1,
+        cluster_space='distances', eps_statistic=None, eps_error=0.01):
     """
     Returns dbscan clustering results using inferred eps and minsample options.
-    eps is the average of the documents' distances and minsample is X% of the
-    number of data points.
+    minsample is X% of the number of data points. eps is based on
+    /eps_statistic/, see EPS_STATISTICS; by default the mean in the distances
+    space and knn in the centroids space. In the distances space the mean and
+    median are taken from the distance matrix, in the centroids space they
+    are estimated from a sample with a relative standard error of
+    /eps_error/ and the matrix is never built.
     """
+    if eps_statistic is None:
+        eps_statistic = 'knn' if cluster_space == 'centroids' else 'mean'
+    if eps_statistic not in EPS_STATISTICS:
+        raise ValueError('unknown eps statistic "{statistic}"'.format(
+            statistic=eps_statistic))
     doc_matrix, doc_list = documents.as_centroid_matrix()
-    matrix = compute_distance_matrix(doc_matrix)
     
     #estimate min_samples
     X = 0.01 * X #percentage
     min_samples = X * len(doc_list)
-    #estimate eps
-    avg = np.average(matrix)
-    #median = np.median(matrix)
     #eps is "the maximum distance between two samples for them to be considered as
-    #in the same neighborhood." setting the upper bound based on matrix
-    cluster_options = {'eps':round(avg*4 ,2), 'min_samples':min_samples}
-    #cluster_options = {'eps':round(median*5 ,2), 'min_samples':min_samples}
+    #in the same neighborhood."
+    if cluster_space == 'centroids':
+        matrix = doc_matrix
+        if eps_statistic == 'knn':
+            eps = estimate_eps_knn(matrix, min_samples)
+        else:
+            #estimate the statistic without the distance matrix
+            stats = estimate_distance_stats(matrix, rel_error=eps_error,
+                    median=(eps_statistic == 'median'))
+            eps = round(stats[eps_statistic]*EPS_FACTORS[eps_statistic], 2)
+        cluster_options = {'eps':eps, 'min_samples':min_samples}
+        fit_options = dict(cluster_options, algorithm='ball_tree')
+    elif cluster_space == 'distances':
+        matrix = compute_distance_matrix(doc_matrix)
+        #setting the upper bound based on matrix
+        if eps_statistic == 'knn':
+            eps = estimate_eps_knn(matrix, min_samples)
+        elif eps_statistic == 'median':
+            eps = round(np.median(matrix)*EPS_FACTORS['median'], 2)
+        else:
+            eps = round(np.average(matrix)*EPS_FACTORS['mean'], 2)
+        cluster_options = {'eps':eps, 'min_samples':min_samples}
+        fit_options = cluster_options
+    else:
+        raise ValueError('unknown cluster space "{space}"'.format(
+            space=cluster_space))
 
     cluster_alg = DBSCAN
     logging.info('Cluster algorithm is {alg}; options estimation is {options}'.format(
         alg=cluster_alg.__name__, options=cluster_options))
 
-    cluster_res = cluster_alg(**cluster_options).fit(matrix)
+    cluster_res = cluster_alg(**fit_options).fit(matrix)
     clusters = process_clustering(cluster_res, doc_list, documents)
     return clusters
 
 
-def perform_clustering(cluster_alg, matrix, cluster_options):
-    """Used /alg/ to cluster the data in /similarity_matrix/."""
+def estimate_distance_stats(matrix, rel_error=0.01, median=False,
+        block_size=None, max_median_sample=100000, seed=0):
+    """
+    Estimates the mean of all pairwise euclidean distances of the lines of
+    /matrix/ (the average of its distance matrix) without computing the
+    distance matrix. Randomly chosen lines are compared to all lines block by
+    block until the relative standard error of the mean drops below
+    /rel_error/; with rel_error=0 all lines are used and the mean is exact.
+    If /median/ is set, the median is estimated from up to
+    /max_median_sample/ of the computed distances as well.
+
+    Returns a dictionary with the keys mean, median (if requested), std_error
+    and rows (the number of lines compared to all others).
+    """
+    n = len(matrix)
+    if block_size is None:
+        #about a million distances per block
+        block_size = max(1, (1 << 20) // n)
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(n)
+
+    row_means = []
+    median_sample = []
+    n_blocks = max(1, n // block_size)
+    std_error = 0.0
+    for start in range(0, n, block_size):
+        block = distance.cdist(matrix[order[start:start+block_size]], matrix,
+                'euclidean')
+        row_means.extend(block.mean(axis=1))
+        if median:
+            per_block = max(1, max_median_sample // n_blocks)
+            block = block.ravel()
+            if len(block) > per_block:
+                block = block[rng.choice(len(block), per_block, replace=False)]
+            median_sample.append(block)
+
+        count = len(row_means)
+        if count < 2 or count == n:
+            continue
+        mean = np.mean(row_means)
+        #standard error with finite population correction
+        std_error = (np.std(row_means, ddof=1) / np.sqrt(count) *
+                np.sqrt((n - count) / float(n - 1)))
+        if std_error <= rel_error * mean:
+            break
+
+    stats = {'mean': float(np.mean(row_means)), 'std_error': float(std_error),
+            'rows': len(row_means)}
+    if len(row_means) == n:
+        stats['std_error'] = 0.0
+    if median:
+        stats['median'] = float(np.median(np.concatenate(median_sample)))
+    logging.debug('distance statistics from {rows} of {n} documents: '
+            '{stats}'.format(rows=len(row_means), n=n, stats=stats))
+    return stats
+
+
+def estimate_eps_knn(matrix, min_samples, sample_size=1000, seed=0):
+    """
+    Estimates eps for dbscan on the points in /matrix/ as the median distance
+    of up to /sample_size/ randomly chosen points to their /min_samples/-th
+    nearest neighbor (counting the point itself, as dbscan does). About half
+    of the points are core points then.
+    """
+    k = int(min(max(1, round(min_samples)), len(matrix)))
+    rng = np.random.RandomState(seed)
+    if len(matrix) > sample_size:
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+    else:
+        sample = matrix
+    k_dist = BallTree(matrix).query(sample, k=k)[0][:, -1]
+    return round(float(np.median(k_dist)), 4)
+
+
+def perform_clustering(cluster_alg, matrix, cluster_options,
+        cluster_space='distances'):
+    """Used /alg/ to cluster the data in /matrix/ in /cluster_space/."""
     logging.info('Cluster algorithm is {alg}; options are {options}'.format(
         alg=cluster_alg.__name__, options=cluster_options))
-    matrix = compute_distance_matrix(matrix)
+    if cluster_alg in CENTROID_ALGORITHMS:
+        pass
+    elif cluster_space == 'distances':
+        matrix = compute_distance_matrix(matrix)
+    elif cluster_space == 'centroids':
+        if cluster_alg is DBSCAN:
+            #find neighbors with a spatial index, not a distance matrix
+            cluster_options = dict(cluster_options)
+            cluster_options.setdefault('algorithm', 'ball_tree')
+    else:
+        raise ValueError('unknown cluster space "{space}"'.format(
+            space=cluster_space))
     cluster_res = cluster_alg(**cluster_options).fit(matrix)
     return cluster_res
 
 
+class StreamingKMeans:
+    """
+    Mini-batch k-means on document centroids that is updated with
+    partial_fit while documents are represented, e.g. as the callback of
+    Documents. Centroids are collected until a batch of at least /batch_size/
+    (and n_clusters) documents is complete.
+    """
+
+    #number of documents assign reads at once
+    ASSIGN_ROWS = 1 << 14
+
+    def __init__(self, cluster_options, batch_size=None):
+        self.model = MiniBatchKMeans(**cluster_options)
+        self.batch_size = max(batch_size or self.model.batch_size,
+                self.model.n_clusters)
+        self._batch = []
+        self._batch_len = 0
+        #number of documents the model was updated with
+        self.n_documents = 0
+
+
+    def __call__(self, centroids):
+        self.partial_fit(centroids)
+
+
+    def partial_fit(self, centroids):
+        """Adds the document /centroids/ (one per line) to the clustering."""
+        self._batch.append(np.asarray(centroids))
+        self._batch_len += len(centroids)
+        if self._batch_len >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """Updates the model with the collected centroids."""
+        if not self._batch:
+            return
+        if not self.is_fitted() and self._batch_len < self.model.n_clusters:
+            #too few documents to initialize the clusters yet
+            return
+        self.model.partial_fit(np.vstack(self._batch))
+        self.n_documents += self._batch_len
+        self._batch = []
+        self._batch_len = 0
+
+
+    def is_fitted(self):
+        return hasattr(self.model, 'cluster_centers_')
+
+
+    def assign(self, matrix):
+        """
+        Assigns the lines of /matrix/ to the closest clusters and returns the
+        model with the assignment as labels_. The model is fitted to
+        /matrix/ if it has not seen any documents yet.
+        """
+        self.flush()
+        if not self.is_fitted():
+            self.model.fit(matrix)
+        else:
+            logging.debug('clusters were updated with {count} documents'.format(
+                count=self.n_documents))
+            #assign block by block, the matrix may be memory-mapped from disk
+            labels = np.empty(len(matrix), dtype=np.int32)
+            for start in range(0, len(matrix), self.ASSIGN_ROWS):
+                end = start + self.ASSIGN_ROWS
+                labels[start:end] = self.model.predict(matrix[start:end])
+            self.model.labels_ = labels
+        return self.model
+
+
 def compute_distance_matrix(matrix):
     """
     Computes distance matrix D for the documents and returns it together with
@@ -91,23 +310,115 @@ def compute_similarity_matrix(matrix):
 
 def process_clustering(cluster_res, doc_list, documents):
     """Takes the cluster result and creates a more readable representation."""
-    labels = cluster_res.labels_
-    #Number of clusters in labels, ignoring noise if present.
-    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
+    labels = np.asarray(cluster_res.labels_)
+    doc_list = np.asarray(doc_list)
+    #store the cluster information in documents
+    documents.labels[documents.rows(doc_list)] = labels + 1 #cluster names start at 1
+
+    #group the members of each cluster with one stable sort
+    order = np.argsort(labels, kind='mergesort')
+    ks, starts, counts = np.unique(labels[order], return_index=True,
+            return_counts=True)
 
     clusters = {}
-    for k in set(labels):
-        class_members = [index[0] for index in np.argwhere(labels == k)]
-        member_docs = []
-        count = 0
-        for m in class_members:
-            doc = doc_list[m]
-            #store the cluster information in the doc object
-            documents.docs[doc].set_cluster_assignment(k+1) #cluster names start at 1
-            member_docs.append(doc)
-            count += 1
+    for k, start, count in zip(ks, starts, counts):
         if k != -1:
+            member_docs = doc_list[order[start:start+count]].tolist()
             clusters['cluster{k} #{count}'.format(k=int(k)+1,count=count)] = member_docs
         else:
             logging.info('Could not cluster {count} documents'.format(count=count))
     return clusters
+
+
+#name process_clustering gives to cluster k with count members
+CLUSTER_NAME = re.compile(r'^cluster(?P<k>\d+) #(?P<count>\d+)$')
+
+def update_clusters(clusters, documents, added, removed, drift_threshold=0.5,
+        centers=None):
+    """
+    Updates the clustering /clusters/ ({cluster_name : [documents]} as
+    created by process_clustering) instead of clustering again: the /removed/
+    documents are dropped and every /added/ document is assigned to the
+    cluster with the nearest centroid. All documents that stay in the
+    clustering must be in /documents/.
+
+    The drift of a cluster is how far its centroid moves from the old
+    centroid, relative to the average distance of its remaining members to
+    the old centroid. Clusters whose members all lie on the old centroid get
+    the average of the other clusters' distances. The old centroids are
+    taken from /centers/ ({cluster_name : centroid}, as stored when the
+    clustering was saved) so removed documents count as well. Without them
+    the centroids of the remaining members are used.
+
+    Returns the updated clusters and the old centroids of them, under their
+    new names. The old centroids should be stored with the clustering
+    instead of the updated ones, so the drift of later updates adds up.
+    Returns None, None if the drift of any cluster exceeds
+    /drift_threshold/, the documents should be clustered again then.
+    """
+    removed = set(removed)
+    names = sorted(clusters)
+    members = [[doc for doc in clusters[name] if doc not in removed]
+            for name in names]
+    #clusters without remaining members are dropped
+    kept = [i for i, docs in enumerate(members) if docs]
+    if not kept:
+        logging.info('no documents of the previous clustering left')
+        return None, None
+    names = [names[i] for i in kept]
+    members = [members[i] for i in kept]
+
+    centroids = documents.centroids
+    labels = np.concatenate([np.repeat(k, len(docs))
+        for k, docs in enumerate(members)])
+    rows = documents.rows([doc for docs in members for doc in docs])
+    counts = np.bincount(labels, minlength=len(names)).astype(np.float64)
+    sums = np.zeros((len(names), centroids.shape[1]))
+    np.add.at(sums, labels, centroids[rows])
+    old_centers = sums / counts[:, np.newaxis]
+    if centers is not None:
+        for k, name in enumerate(names):
+            if name in centers:
+                old_centers[k] = np.ravel(centers[name])
+    #average distance of the members to their cluster centroid
+    member_dist = np.linalg.norm(centroids[rows] - old_centers[labels], axis=1)
+    spread = np.bincount(labels, member_dist, minlength=len(names)) / counts
+    #e.g. a single member on its stored centroid would make any shift infinite
+    has_spread = spread > 0
+    if has_spread.any():
+        spread[~has_spread] = spread[has_spread].mean()
+
+    #assign the new documents to the nearest cluster centroid
+    added_rows = documents.lookup(added)
+    added = [doc for doc, row in zip(added, added_rows) if row != -1]
+    added_rows = added_rows[added_rows != -1]
+    if added:
+        nearest = distance.cdist(centroids[added_rows], old_centers).argmin(axis=1)
+        np.add.at(sums, nearest, centroids[added_rows])
+        counts += np.bincount(nearest, minlength=len(names))
+        for doc, k in zip(added, nearest):
+            members[k].append(doc)
+    new_centers = sums / counts[:, np.newaxis]
+
+    shift = np.linalg.norm(new_centers - old_centers, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drift = np.where(shift > 0, shift / spread, 0.0)
+    logging.info('added {added} and removed {removed} documents; cluster drift '
+            'is {drift:.3f}'.format(added=len(added), removed=len(removed),
+                drift=drift.max()))
+    if drift.max() > drift_threshold:
+        logging.info('drift exceeds {threshold}'.format(
+            threshold=drift_threshold))
+        return None, None
+
+    updated = {}
+    updated_centers = {}
+    for i, (name, docs) in enumerate(zip(names, members)):
+        match = CLUSTER_NAME.match(name)
+        k = int(match.group('k')) if match else i+1
+        if match:
+            name = 'cluster{k} #{count}'.format(k=k, count=len(docs))
+        documents.labels[documents.rows(docs)] = k
+        updated[name] = docs
+        updated_centers[name] = old_centers[i]
+    return updated, updated_centers
@@ -3,32 +3,394 @@ from __future__ import unicode_literals
 
 import logging
 import codecs
+import multiprocessing
 import os
 
+import numpy as np
 import scipy
+import scipy.sparse
+
+import Cache
+
+#number of characters read from a document at once
+CHUNK_SIZE = 1 << 16
+
+def iter_word_chunks(fname, chunk_size=CHUNK_SIZE):
+    """
+    Reads file /fname/ /chunk_size/ characters at a time and yields the words
+    of each chunk as a list. A word cut by the end of a chunk is completed
+    with the next chunk, so the memory needed does not depend on the size or
+    the line lengths of the file.
+    """
+    with codecs.open(fname, 'r', 'utf-8') as doc_file:
+        rest = ''
+        while True:
+            chunk = doc_file.read(chunk_size)
+            if not chunk:
+                break
+            words = (rest + chunk).split()
+            rest = ''
+            if words and not chunk[-1].isspace():
+                rest = words.pop()
+            yield words
+        if rest:
+            yield [rest]
+
 
 def repr_with_tm(fname, tm):
     """
     Read file /fname/ and map each word to the id of the corresponding topic
     vector in /tm/ and save the result in a list. With the list and the topic
     model you can construct a word_id_list of topic vectors representing the
-    document.
+    document. Use count_words to avoid a list entry per word.
     """
     #!Warning!: The resulting word_id_list is bound to the topic models vocabulary.
     #Work with the ids only if you are sure you are working with the same
     #tm.vocab
-    with codecs.open(fname, 'r', 'utf-8') as doc_file:
-        for line in doc_file:
-            if line.isspace():
+    word_id_list = [] #stores the tm ids of the words in the document
+    for words in iter_word_chunks(fname):
+        #word = word.lower()
+        word_ids = tm.vocab.ids(words)
+        word_id_list.extend(word_ids[word_ids != -1].tolist())
+    if not word_id_list:
+        logging.debug('Found no known word in file {fname}'.format(fname=fname))
+    return word_id_list
+
+
+def count_words(fname, tm):
+    """
+    Returns the ids of the words in file /fname/ that are known to /tm/ and
+    how often each of them occurs as two arrays sorted by id. The file is
+    streamed, memory only grows with the number of distinct words.
+    """
+    bow = bag_of_words([fname], tm)
+    if bow.nnz == 0:
+        logging.debug('Found no known word in file {fname}'.format(fname=fname))
+    return bow.indices, bow.data
+
+
+def _count_document_words(fname):
+    """Returns a dictionary {word : count} of all words in file /fname/."""
+    counts = {}
+    get = counts.get
+    for words in iter_word_chunks(fname):
+        for word in words:
+            counts[word] = get(word, 0) + 1
+    return counts
+
+
+def bag_of_words(fnames, tm):
+    """
+    Returns a sparse matrix holding the word counts of the documents /fnames/.
+    Each line represents one document, each row represents one word of the
+    vocabulary of /tm/. The distinct words of each document are looked up in
+    the vocabulary together with those of the other documents.
+    """
+    indptr = np.zeros(len(fnames)+1, dtype=np.int64)
+    words = []
+    counts = []
+    for row, fname in enumerate(fnames):
+        doc_counts = _count_document_words(fname)
+        words.extend(doc_counts.iterkeys())
+        counts.extend(doc_counts.itervalues())
+        indptr[row+1] = len(words)
+    word_ids = tm.vocab.ids(words)
+    del words
+    #leave out unknown words
+    known = word_ids != -1
+    known_before = np.concatenate(([0], np.cumsum(known)))
+    bow = scipy.sparse.csr_matrix((np.array(counts, dtype=np.int64)[known],
+        word_ids[known].astype(np.int32), known_before[indptr]),
+        shape=(len(fnames), len(tm.vocab)))
+    bow.sort_indices()
+    return bow
+
+
+def compute_centroids(bow, tm, flavor='avg'):
+    """
+    Computes the centroids of all documents in the bag of words matrix /bow/
+    at once. /flavor/ is either avg or exp, see Document. Returns the centroid
+    matrix and a boolean array that is False for documents without any known
+    word; their centroids are zero.
+    """
+    flavors = {'avg': _centroids_avg, 'exp': _centroids_avg_experimental}
+    compute = flavors[flavor]
+    n_words = np.asarray(bow.sum(axis=1)).ravel()
+    represented = n_words > 0
+    if represented.all():
+        return compute(bow, tm, n_words.astype(np.float64)), represented
+    #leave out empty documents, they have no centroid
+    centroids = np.zeros((bow.shape[0], len(tm)))
+    centroids[represented] = compute(bow[represented], tm,
+            n_words[represented].astype(np.float64))
+    return centroids, represented
+
+
+def represent_files(fnames, tm, flavor='avg', workers=1, cache=None,
+        callback=None, counts=None):
+    """
+    Returns the centroids of the documents /fnames/ like compute_centroids.
+    The documents are represented in batches, see iter_centroid_batches.
+    If a CentroidCache is given, only documents that are not in the /cache/
+    are read and their centroids are added to it. /callback/ is called with
+    the centroids of the represented documents of every batch as soon as the
+    batch is done, e.g. to update a clustering. The number of documents
+    read and of known words in them are added to the dictionary /counts/
+    if it is given.
+    """
+    if cache is None:
+        return _represent_files(fnames, tm, flavor, workers, callback, counts)
+
+    cached = cache.lookup(fnames, tm.fingerprint, flavor)
+    missing = [fname for fname in fnames if fname not in cached]
+    logging.debug('found {hits} of {count} documents in the cache'.format(
+        hits=len(fnames)-len(missing), count=len(fnames)))
+    if callback is not None:
+        cached_centroids = [centroid for centroid in cached.itervalues()
+                if centroid is not None]
+        if cached_centroids:
+            callback(np.vstack(cached_centroids))
+    new_centroids, new_represented = _represent_files(missing, tm, flavor,
+            workers, callback, counts)
+    cache.store(missing, new_centroids, new_represented, tm.fingerprint, flavor)
+
+    centroids = np.zeros((len(fnames), len(tm)))
+    represented = np.zeros(len(fnames), dtype=bool)
+    new_rows = dict((fname, row) for row, fname in enumerate(missing))
+    for row, fname in enumerate(fnames):
+        if fname in new_rows:
+            centroids[row] = new_centroids[new_rows[fname]]
+            represented[row] = new_represented[new_rows[fname]]
+        elif cached[fname] is not None:
+            centroids[row] = cached[fname]
+            represented[row] = True
+    return centroids, represented
+
+
+def _represent_files(fnames, tm, flavor, workers, callback=None, counts=None):
+    """Collects the batches of iter_centroid_batches in one matrix."""
+    centroids = np.zeros((len(fnames), len(tm)))
+    represented = np.zeros(len(fnames), dtype=bool)
+    row = 0
+    for batch_centroids, batch_represented, n_words in iter_centroid_batches(
+            fnames, tm, flavor, workers):
+        _add_counts(counts, len(batch_represented), n_words)
+        end = row + len(batch_represented)
+        centroids[row:end] = batch_centroids
+        represented[row:end] = batch_represented
+        if callback is not None and batch_represented.any():
+            callback(batch_centroids[batch_represented])
+        row = end
+    return centroids, represented
+
+
+def represent_files_to_disk(fnames, tm, centroid_file, flavor='avg',
+        workers=1, callback=None, counts=None):
+    """
+    Represents the documents /fnames/ batch by batch like represent_files,
+    but writes the centroids of the represented documents to the .npy file
+    /centroid_file/ instead of collecting them in memory, so the memory
+    needed depends on the batch size and not on the number of documents.
+    The name of the document in each line is written to a companion file,
+    see read_centroid_index. Both files are reused as long as the documents,
+    the topic model and the /flavor/ do not change. Returns the
+    memory-mapped centroids and the list of document names. /counts/ is
+    updated like in represent_files.
+    """
+    index_file = centroid_index_file(centroid_file)
+    key = {'model': tm.fingerprint, 'flavor': flavor,
+            'documents': Cache.fingerprint(*fnames)}
+    centroids = Cache.load_array(centroid_file, key)
+    if centroids is not None:
+        doc_names = read_centroid_index(index_file)
+        if doc_names is not None and len(doc_names) == len(centroids):
+            logging.debug('loaded centroids from "{file}"'.format(
+                file=centroid_file))
+            if callback is not None:
+                for start in range(0, len(centroids), BATCH_SIZE):
+                    callback(centroids[start:start+BATCH_SIZE])
+            return centroids, doc_names
+
+    centroids = Cache.create_array(centroid_file, (len(fnames), len(tm)))
+    doc_names = []
+    with open(index_file + '.tmp', 'w') as ifile:
+        start = 0
+        for batch_centroids, batch_represented, n_words in iter_centroid_batches(
+                fnames, tm, flavor, workers):
+            _add_counts(counts, len(batch_represented), n_words)
+            batch_names = fnames[start:start+len(batch_represented)]
+            start += len(batch_represented)
+            for fname, is_repr in zip(batch_names, batch_represented):
+                if not is_repr:
+                    logging.error('document "{name}" seems to be empty!'.format(
+                        name=fname))
+            batch_centroids = batch_centroids[batch_represented]
+            if len(batch_centroids) == 0:
                 continue
-            word_id_list = [] #stores the tm ids of the words in the document
-            for word in line.split():
-                #word = word.lower()
-                if tm.word_id_dict.has_key(word):
-                    word_id_list.append(tm.word_id_dict[word])
-        if not word_id_list:
-            logging.debug('Found no known word in file {fname}'.format(fname=fname))
-        return word_id_list
+            row = len(doc_names)
+            centroids[row:row+len(batch_centroids)] = batch_centroids
+            batch_names = [fname for fname, is_repr in zip(batch_names,
+                batch_represented) if is_repr]
+            doc_names.extend(batch_names)
+            ifile.write(b''.join(fname + b'\n' for fname in batch_names))
+            if callback is not None:
+                callback(batch_centroids)
+    os.rename(index_file + '.tmp', index_file)
+
+    if not Cache.commit_array(centroid_file, key, centroids, len(doc_names)):
+        return np.asarray(centroids[:len(doc_names)]), doc_names
+    del centroids
+    return Cache.load_array(centroid_file, key), doc_names
+
+
+def _add_counts(counts, n_docs, n_words):
+    if counts is not None:
+        counts['read'] = counts.get('read', 0) + n_docs
+        counts['words'] = counts.get('words', 0) + n_words
+
+
+def centroid_index_file(centroid_file):
+    """Returns the file holding the document names of /centroid_file/."""
+    return centroid_file + '.ids'
+
+
+def read_centroid_index(index_file):
+    """
+    Returns the document names in /index_file/, one per line of the
+    centroid file, or None if it cannot be read.
+    """
+    try:
+        with open(index_file, 'r') as ifile:
+            return [line.rstrip(b'\n') for line in ifile]
+    except IOError:
+        return None
+
+
+#number of documents represented at once by one process
+BATCH_SIZE = 1000
+
+def iter_centroid_batches(fnames, tm, flavor='avg', workers=1,
+        batch_size=BATCH_SIZE):
+    """
+    Represents the documents /fnames/ in batches of up to /batch_size/ files
+    and yields the result of compute_centroids for every batch together with
+    the number of known words in the batch. With more
+    than one worker the batches are represented in a process pool. The
+    batches are yielded in the order of /fnames/, so the result does not
+    depend on the number of workers.
+    """
+    if workers > 1:
+        #a few batches per worker keep the workers busy until the end
+        batch_size = max(1, min(batch_size, len(fnames) // (workers * 4)))
+    batches = [fnames[start:start+batch_size]
+            for start in range(0, len(fnames), batch_size)]
+    if workers <= 1 or len(batches) < 2:
+        for batch in batches:
+            yield _represent_batch(batch, tm, flavor)
+        return
+
+    if flavor == 'exp':
+        #compute once before the workers inherit the topic model
+        tm.normalized_word_topics()
+    pool = multiprocessing.Pool(workers, _init_worker, (tm,))
+    try:
+        for res in pool.imap(_represent_chunk,
+                [(batch, flavor) for batch in batches]):
+            yield res
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+#topic model of a worker process of represent_files
+_worker_tm = None
+
+def _init_worker(tm):
+    global _worker_tm
+    _worker_tm = tm
+
+
+def _represent_chunk(args):
+    fnames, flavor = args
+    return _represent_batch(fnames, _worker_tm, flavor)
+
+
+def _represent_batch(fnames, tm, flavor):
+    bow = bag_of_words(fnames, tm)
+    centroids, represented = compute_centroids(bow, tm, flavor)
+    return centroids, represented, int(bow.data.sum())
+
+
+def _centroids_avg(bow, tm, n_words):
+    """Normalized average of the topic vectors of all words per document."""
+    centroids = bow.dot(np.asarray(tm.word_topics)) / n_words[:, np.newaxis]
+    return _normalize_rows(centroids)
+
+
+def _centroids_avg_experimental(bow, tm, n_words):
+    """Average of the *normalized* topic vectors of all words per document."""
+    return bow.dot(tm.normalized_word_topics()) / n_words[:, np.newaxis]
+
+
+def _normalize_rows(matrix):
+    """
+    Normalize each line of /matrix/ to a range between 0 and 1, the same way
+    _normalize_vector does for a single vector.
+    """
+    v_min = matrix.min(axis=1)[:, np.newaxis]
+    v_max = matrix.max(axis=1)[:, np.newaxis]
+    return (matrix - v_min) / (v_max - v_min)
+
+
+#number of document centroids cluster_averages reads at once
+BLOCK_ROWS = 1 << 14
+
+def cluster_averages(centroids, members, sizes=None, weights=None):
+    """
+    Returns one average centroid per cluster. /members/ holds the lines of
+    /centroids/ that belong to each cluster; the sum of their centroids is
+    divided by the cluster's entry in /sizes/ (the number of members if not
+    given). If /weights/ (one per line of centroids) are given, the weighted
+    average of the members is computed instead.
+    """
+    cluster_ids = np.repeat(np.arange(len(members)),
+            [len(rows) for rows in members])
+    rows = np.concatenate([np.asarray(rows, dtype=np.intp) for rows in members]
+            + [np.empty(0, dtype=np.intp)])
+    if weights is None:
+        values = np.ones(len(rows))
+        if sizes is None:
+            sizes = [len(rows) for rows in members]
+        sizes = np.asarray(sizes, dtype=np.float64)
+    else:
+        values = np.asarray(weights, dtype=np.float64)[rows]
+        sizes = np.bincount(cluster_ids, values, minlength=len(members))
+    #clusters without members keep a zero centroid
+    sizes[sizes == 0] = 1
+    indicator = scipy.sparse.csc_matrix((values / sizes[cluster_ids],
+        (cluster_ids, rows)), shape=(len(members), len(centroids)))
+    if len(centroids) <= BLOCK_ROWS:
+        return indicator.dot(centroids)
+    #sum up block by block, the centroids may be memory-mapped from disk
+    res = np.zeros((len(members), centroids.shape[1]))
+    for start in range(0, len(centroids), BLOCK_ROWS):
+        end = start + BLOCK_ROWS
+        res += indicator[:, start:end].dot(centroids[start:end])
+    return res
+
+
+def path_array(paths):
+    """
+    Returns the document /paths/ as an array of byte strings. Unicode paths
+    are encoded as utf-8.
+    """
+    if isinstance(paths, np.ndarray) and paths.dtype.kind == 'S':
+        return paths
+    return np.array([path.encode('utf-8') if isinstance(path, unicode) else path
+        for path in paths], dtype=bytes)
 
 
 def _normalize_vector(vec):
@@ -43,139 +405,254 @@ def _normalize_vector(vec):
 
 
 class Documents:
-    """Represent Documents using topic models"""
+    """
+    Represent Documents using topic models. /callback/ receives the centroids
+    batch by batch while the documents are represented, see represent_files.
+    If a /centroid_file/ is given, the centroids are kept on disk instead of
+    in memory, see represent_files_to_disk.
+    """
 
-    def __init__(self, doc_source, tm, centroid_computation):
+    def __init__(self, doc_source, tm, centroid_computation, workers=1,
+            cache=None, callback=None, centroid_file=None):
         self.tm = tm
-        #load absolute file names of text files
+        #number of documents read and known words in them, documents
+        #from a cache are not read
+        self.counts = {'read': 0, 'words': 0}
+        #load absolute file names of text files, sorted so they can be looked
+        #up with a binary search
         fnames = []
         if isinstance(doc_source, str):
             doc_dir = os.path.abspath(doc_source) + os.sep
-            fnames = [doc_dir + doc for doc in os.listdir(doc_dir) if
+            fnames = [doc_dir + doc for doc in sorted(os.listdir(doc_dir)) if
                     doc.endswith('.txt')]
         elif isinstance(doc_source, list):
-            raw_fnames = []
-            for doc in doc_source:
-                base = os.path.basename(doc)
-                if base.endswith('.txt'):
-                    doc_dir = os.path.abspath(doc)
-                    fnames.append(doc_dir)
+            #represent every document once
+            fnames = np.unique(path_array([os.path.abspath(doc)
+                for doc in doc_source if doc.endswith('.txt')])).tolist()
 
         #represent documents with help of topics
-        self.docs = {}
-        for fname in fnames:
-            doc = Document(fname, tm, centroid_computation)
-            if doc.centroid is not None:
-                self.docs[fname] = doc
+        if centroid_file:
+            if cache is not None:
+                logging.debug('not using the centroid cache for centroids on disk')
+            centroids, fnames = represent_files_to_disk(fnames, tm,
+                    centroid_file, centroid_computation, workers, callback,
+                    self.counts)
+        else:
+            centroids, represented = represent_files(fnames, tm,
+                    centroid_computation, workers, cache, callback, self.counts)
+            for row in np.flatnonzero(~represented):
+                logging.error('document "{name}" seems to be empty!'.format(
+                    name=fnames[row]))
+            if not represented.all():
+                centroids = centroids[represented]
+                fnames = [fname for fname, is_repr in zip(fnames, represented)
+                        if is_repr]
+            centroids = np.ascontiguousarray(centroids)
+
+        #the documents are stored column by column: one line of centroids,
+        #one sorted path and one label per document
+        self.centroids = centroids
+        self.paths = path_array(fnames)
+        del fnames
+        #cluster assignment of each document, -1 if it is not assigned
+        self.labels = np.empty(len(self.paths), dtype=np.int32)
+        self.labels.fill(-1)
+
+
+    def __len__(self):
+        return len(self.paths)
+
+
+    def __contains__(self, fname):
+        return self.lookup([fname])[0] != -1
+
+
+    def get_document(self, fname):
+        """
+        Returns the Document /fname/. It is a view on the line of the
+        document in centroids and labels.
+        """
+        return self.document_at(self.rows([fname])[0])
+
+
+    def document_at(self, row):
+        """Returns the Document in line /row/, see get_document."""
+        return Document(self.paths[row], centroid=self.centroids[row],
+                labels=self.labels, row=row)
+
+
+    def iter_documents(self):
+        """Yields a Document view for every document."""
+        for row in range(len(self.paths)):
+            yield self.document_at(row)
 
 
     def as_centroid_matrix(self):
         """
         Returns a matrix consisting of the document centroids and a list
         holding the information which document's centroid is in which line of
-        the matrix.
+        the matrix. Both are the ones stored in Documents, not copies, and
+        must not be changed.
+        """
+        assert len(self.paths) > 0
+        return self.centroids, self.paths
+
+
+    def lookup(self, doc_list):
+        """
+        Returns the lines of the documents in /doc_list/ as an array, -1 for
+        documents that are not represented.
         """
-        id_list = []
+        if doc_list is self.paths:
+            return np.arange(len(self.paths))
+        keys = path_array(doc_list)
+        if len(self.paths) == 0:
+            return np.repeat(np.intp(-1), len(keys))
+        rows = np.searchsorted(self.paths, keys)
+        rows[rows == len(self.paths)] = 0
+        rows[self.paths[rows] != keys] = -1
+        return rows
+
+
+    def rows(self, doc_list):
+        """
+        Returns the lines of the documents in /doc_list/ as an array. Raises a
+        KeyError if a document is not represented.
+        """
+        rows = self.lookup(doc_list)
+        if (rows == -1).any():
+            raise KeyError(doc_list[np.flatnonzero(rows == -1)[0]])
+        return rows
+
 
-        assert len(self.docs) > 0
-        doc_centroid_matrix = scipy.zeros((0,len(self.tm)))
-        for key, doc in self.docs.iteritems():
-            id_list.append(key)
-            doc_centroid_matrix = scipy.vstack(
-                    (doc_centroid_matrix, doc.centroid))
-        return doc_centroid_matrix, id_list
+    def reset_cluster_assignments(self):
+        self.labels.fill(-1)
 
 
     def compute_cluster_centroid(self, doc_list, flavor='avg'):
         """
-        Iterates over the doc_list and returns the average of all document's
-        centroids.
-        """
-        cluster_centroid = scipy.zeros((1,len(self.tm)))
-        for doc in doc_list:
-            #add document centroid to the matrix
-            try:
-                centroid = self.docs[doc].centroid
-            except KeyError as ke:
-                logging.error(ke)
-                logging.warning('centroid missing for document "{doc}"'.format(doc=doc))
-                continue
-            if centroid != None:
-                cluster_centroid += centroid
-        cluster_centroid /= len(doc_list)
-        return cluster_centroid
+        Returns the average of all document's centroids in doc_list, see
+        compute_cluster_centroids.
+        """
+        return self.compute_cluster_centroids({'': doc_list}, flavor)['']
+
+
+    def compute_cluster_centroids(self, clusters, flavor='avg', weights=None):
+        """
+        Returns a dictionary {cluster_name : cluster_centroid} for the
+        clusters {cluster_name : [documents]}. The average centroids of all
+        clusters are computed with one product of a sparse cluster x document
+        matrix and the centroid matrix. Documents without a centroid are
+        skipped but still count for the average, as before. With /flavor/
+        median the median of the documents' centroids is used instead. If
+        /weights/ (one per line of centroids) are given, the weighted
+        average of the documents in each cluster is computed.
+        """
+        names = list(clusters)
+        members = []
+        for name in names:
+            doc_list = clusters[name]
+            rows = self.lookup(doc_list)
+            for missing in np.flatnonzero(rows == -1):
+                logging.warning('centroid missing for document "{doc}"'.format(
+                    doc=doc_list[missing]))
+            members.append(rows[rows != -1])
+
+        if flavor == 'median':
+            cluster_centroids = np.zeros((len(names), len(self.tm)))
+            for i, rows in enumerate(members):
+                if len(rows):
+                    cluster_centroids[i] = np.median(self.centroids[rows], axis=0)
+        elif flavor == 'avg':
+            cluster_centroids = cluster_averages(self.centroids, members,
+                    [len(clusters[name]) for name in names], weights)
+        else:
+            raise ValueError('unknown cluster centroid "{flavor}"'.format(
+                flavor=flavor))
 
+        return dict((name, cluster_centroids[i:i+1])
+                for i, name in enumerate(names))
 
-class Document:
-    """Represent a Document"""
-    def __init__(self, fname, tm, centroid_flavor='avg'):
+
+class Document(object):
+    """
+    Represent a Document. The centroid is computed from the file unless it is
+    given, e.g. because it was computed by Documents already. Documents also
+    passes its /labels/ array and the document's /row/ in it, the cluster
+    assignment is stored there then.
+    """
+    #Documents creates many of these, they should not need more memory than
+    #the references to their data
+    __slots__ = ('fname', 'centroid', '_labels', '_row')
+
+    def __init__(self, fname, tm=None, centroid_flavor='avg', centroid=None,
+            labels=None, row=0):
         #define which way is used to compute the centroid of the document
         flavors = {'avg' : self.compute_centroid_avg,
                 'exp' : self.compute_centroid_avg_experimental}
 
         self.fname = fname
-        self.cluster_assignment = -1
-        compute_centroid = flavors[centroid_flavor]
-        word_id_list = repr_with_tm(fname, tm)
-        self.centroid = compute_centroid(tm, word_id_list)
-        del(word_id_list)
+        if labels is None:
+            labels = np.array([-1], dtype=np.int32)
+            row = 0
+        self._labels = labels
+        self._row = row
+        self.centroid = centroid
+        if centroid is None:
+            compute_centroid = flavors[centroid_flavor]
+            word_ids, word_counts = count_words(fname, tm)
+            self.centroid = compute_centroid(tm, word_ids, word_counts)
 
 
     def __str__(self):
         return 'Document "{name}"'.format(name=self.fname)
 
 
+    @property
+    def cluster_assignment(self):
+        return int(self._labels[self._row])
+
+
     def set_cluster_assignment(self, k):
-        self.cluster_assignment = k
+        self._labels[self._row] = k
 
 
-    def compute_centroid_avg(self, tm, word_id_list):
+    def compute_centroid_avg(self, tm, word_ids, word_counts):
         """
         Computes the normalized average of the topic vectors of all words in
-        this document
+        this document, given the ids of its words and how often they occur
         """
         try:
             #no centroid without a vector
-            assert len(word_id_list) > 0
+            assert word_counts.sum() > 0
         except AssertionError as ae:
             logging.error(ae)
             logging.error('document "{name}" seems to be empty!'.format(name=self.fname))
             return None
 
-        #create vector to sum words' topic vectors
-        centroid = scipy.zeros(len(tm.topics))
-        for w_id in word_id_list:
-            topic_vector = tm.get_topic_vector_for_id(w_id)
-            centroid += topic_vector
+        #sum words' topic vectors weighted by their counts
+        centroid = word_counts.dot(tm.word_topics[word_ids])
         #compute the average of the topics
-        centroid = centroid / float(len(word_id_list))
+        centroid = centroid / float(word_counts.sum())
         #normalize the vector to a range between 0 and 1
         centroid = _normalize_vector(centroid)
         return centroid
 
 
-    def compute_centroid_avg_experimental(self, tm, word_id_list):
+    def compute_centroid_avg_experimental(self, tm, word_ids, word_counts):
         """
         Computes the average of the *normalized* topic vectors of all words in
-        this document
+        this document, given the ids of its words and how often they occur
         """
         try:
             #no centroid without a vector
-            assert len(word_id_list) > 0
+            assert word_counts.sum() > 0
         except AssertionError as ae:
             logging.error(ae)
             logging.error('document "{name}" seems to be empty!'.format(name=self.fname))
             return None
 
-        #create vector to sum words' topic vectors
-        centroid = scipy.zeros(len(tm.topics))
-        #TODO if this is used regularly, the normalized topic vector could
-        #already be precomputed in tm
-        for w_id in word_id_list:
-            topic_vector = tm.get_topic_vector_for_id(w_id)
-            #normalize topic vector
-            topic_vector = _normalize_vector(topic_vector)
-            centroid += topic_vector
-        #compute the average of the topics
-        centroid = centroid / float(len(word_id_list))
+        #the normalized topic vectors are precomputed in tm
+        centroid = word_counts.dot(tm.normalized_word_topics()[word_ids])
+        centroid = centroid / float(word_counts.sum())
         return centroid
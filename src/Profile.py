@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+
+#This file is part of Thekla.
+
+"""
+Measures the stages of a run: wall time, CPU time, peak memory and the
+number of items (documents, words, clusters) processed, see Profile.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows, peak memory is not measured there
+    resource = None
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in MB or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on Mac OS
+    if sys.platform == 'darwin':
+        rss /= 1024.
+    return rss / 1024.
+
+
+def cpu_times():
+    """
+    Returns the CPU time used by this process and the CPU time used by its
+    child processes that have been waited for, e.g. the workers of a pool.
+    """
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+class Profile:
+    """
+    Records wall time, CPU time, peak memory and item counts for every stage
+    of a run. A stage is measured with
+
+        with profile.stage('name') as counts:
+            counts['documents'] = ...
+
+    where the block adds the counts of the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        """Measures the block as stage /name/."""
+        wall = time.time()
+        cpu, child_cpu = cpu_times()
+        rss = peak_rss()
+        try:
+            yield counts
+        finally:
+            end_cpu, end_child_cpu = cpu_times()
+            end_rss = peak_rss()
+            res = {'stage': name,
+                    'wall': time.time() - wall,
+                    'cpu': end_cpu - cpu,
+                    'child_cpu': end_child_cpu - child_cpu,
+                    'peak_rss_mb': end_rss,
+                    'rss_growth_mb': end_rss - rss if rss is not None else None,
+                    'counts': counts}
+            self.stages.append(res)
+            logging.debug('stage {stage} took {wall:.3f}s'.format(**res))
+
+
+    def report(self):
+        """Returns the measurements as a dictionary."""
+        rss = [stage['peak_rss_mb'] for stage in self.stages
+                if stage['peak_rss_mb'] is not None]
+        return {'name': self.name,
+                'stages': self.stages,
+                'total': {
+                    'wall': sum(stage['wall'] for stage in self.stages),
+                    'cpu': sum(stage['cpu'] for stage in self.stages),
+                    'child_cpu': sum(stage['child_cpu'] for stage in self.stages),
+                    'peak_rss_mb': max(rss) if rss else None}}
+
+
+    def summary(self):
+        """Returns the measurements as a table, one line per stage."""
+        lines = ['{0:<28} {1:>9} {2:>9} {3:>9} {4:>10}  {5}'.format(
+            'stage', 'wall[s]', 'cpu[s]', 'child[s]', 'peak[MB]', 'counts')]
+        for stage in self.stages + [dict(self.report()['total'],
+            stage='total', counts={})]:
+            counts = ', '.join('{0}={1}'.format(key, value)
+                    for key, value in sorted(stage['counts'].iteritems()))
+            peak = stage['peak_rss_mb']
+            lines.append('{0:<28} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>10}  {5}'.format(
+                stage['stage'], stage['wall'], stage['cpu'],
+                stage['child_cpu'], '-' if peak is None else '{0:.1f}'.format(peak),
+                counts))
+        return '\n'.join(lines)
+
+
+    def write(self, fname):
+        """Writes the report to the JSON file /fname/."""
+        with open(fname, 'w') as pfile:
+            json.dump(self.report(), pfile, indent=2, sort_keys=True)
@@ -2,20 +2,41 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import codecs
-import scipy
 import logging
 
+import numpy as np
+
+import Cache
+
 class TopicModel:
     """Represent a topic model."""
 
-    def __init__(self, vocab_filename, beta_file):
-        #array of words where words' position in the array is also their global id
-        self.vocab = self.load_vocab(vocab_filename)
-        #a dictionary that maps words to their row index in the topics
-        self.word_id_dict = self._create_word_id_dict()
-        #matrix representation of topics. Each line represents one topic, each
-        #row representes one word
-        self.topics = self.create_topic_word_matrix_from_betafile(beta_file)
+    def __init__(self, vocab_filename, beta_file, dtype='float64', cache=True,
+            storage='memory'):
+        #the words, a word's position in the vocabulary is also its global id
+        self.vocab = self.load_vocab(vocab_filename, cache)
+        #identifies the files the model was loaded from, e.g. for caching
+        self.fingerprint = Cache.fingerprint(vocab_filename, beta_file,
+                dtype=np.dtype(dtype).name)
+        #file backing the topics if they are memory-mapped word-major
+        self.word_topics_file = None
+        #word_topics normalized per word, see normalized_word_topics
+        self._normalized_word_topics = None
+        #results of top_topic_words by nwords
+        self._top_topic_words = {}
+        if storage == 'mmap':
+            #each line represents one word, each row represents one topic
+            self.word_topics = self.load_word_topic_matrix(beta_file, dtype)
+            self.topics = self.word_topics.T
+        elif storage == 'memory':
+            #matrix representation of topics. Each line represents one topic, each
+            #row representes one word
+            self.topics = self.create_topic_word_matrix_from_betafile(beta_file,
+                    dtype, cache)
+            self.word_topics = self.topics.T
+        else:
+            raise ValueError('unknown topic model storage "{storage}"'.format(
+                storage=storage))
 
 
     def __str__(self):
@@ -34,76 +55,201 @@ class TopicModel:
         return len(self.topics)
 
 
-    def load_vocab(self, vocab_filename):
+    def __getstate__(self):
+        """Memory-mapped topics are reopened instead of being pickled."""
+        state = self.__dict__.copy()
+        state['_normalized_word_topics'] = None
+        if self.word_topics_file:
+            del state['topics']
+            del state['word_topics']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.word_topics_file:
+            self.word_topics = np.asarray(np.load(self.word_topics_file,
+                mmap_mode='r'))
+            self.topics = self.word_topics.T
+
+
+    def load_vocab(self, vocab_filename, cache=True):
         """
         Loads the given file assuming there is one word per line and the line
-        is the word's id. Returns the respective information as an array where
-        the id of the word is it's index in the array.
+        is the word's id. Returns the respective information as a Vocabulary
+        where the id of the word is it's index.
+
+        If /cache/ is set, the index of the Vocabulary is stored in binary
+        files next to vocab_filename and memory-mapped from there as long as
+        vocab_filename does not change.
         """
+        words_file = '{vocab}.words.npy'.format(vocab=vocab_filename)
+        order_file = '{vocab}.order.npy'.format(vocab=vocab_filename)
+        if cache:
+            key = Cache.source_key(vocab_filename)
+            words = Cache.load_array(words_file, key)
+            order = Cache.load_array(order_file, key)
+            if words is not None and order is not None:
+                logging.debug('loaded vocabulary from cache "{cache}"'.format(
+                    cache=words_file))
+                return Vocabulary(words, order)
+
         try:
             with codecs.open(vocab_filename, 'r', 'utf-8') as vfile:
-                vocab = [v.strip() for v in vfile]
+                vocab = [v.strip().encode('utf-8') for v in vfile]
         except IOError as e:
-            logging.ERROR(e)
+            logging.error(e)
             raise
-        return vocab
+        words, order = Vocabulary.create_index(vocab)
 
+        if cache:
+            Cache.save_array(words_file, key, words)
+            Cache.save_array(order_file, key, order)
+        return Vocabulary(words, order)
 
-    def create_topic_word_matrix_from_betafile(self, beta_file):
+
+    def create_topic_word_matrix_from_betafile(self, beta_file,
+            dtype='float64', cache=True):
         """
         Loads beta_file (stemming from an lda-c run) and represents the contained
         topics as a matrix in a scipy ndarray. Each line represents one topic, each
         row represents a word.
+
+        If /cache/ is set, the matrix is stored in a binary file next to
+        beta_file and memory-mapped from there as long as beta_file does not
+        change.
         """
+        dtype = np.dtype(dtype)
+        cache_file = '{beta}.{dtype}.npy'.format(beta=beta_file, dtype=dtype.name)
+        if cache:
+            key = Cache.source_key(beta_file, dtype=dtype.name)
+            topics = Cache.load_array(cache_file, key)
+            if topics is not None:
+                logging.debug('loaded topics from cache "{cache}"'.format(
+                    cache=cache_file))
+                return topics
+
+        topics = self._parse_betafile(beta_file, dtype)
+
+        if cache:
+            Cache.save_array(cache_file, key, topics)
+        return topics
+
+
+    def load_word_topic_matrix(self, beta_file, dtype='float64'):
+        """
+        Returns the transposed topic matrix (one line per word) memory-mapped
+        from a binary file next to beta_file. The file is (re)created if
+        beta_file changed. Looking up the topic vector of a word then reads
+        one contiguous line and the operating system can share the pages
+        between processes.
+        """
+        dtype = np.dtype(dtype)
+        cache_file = '{beta}.{dtype}.T.npy'.format(beta=beta_file,
+                dtype=dtype.name)
+        key = Cache.source_key(beta_file, dtype=dtype.name, layout='word-major')
+        word_topics = Cache.load_array(cache_file, key)
+        if word_topics is None:
+            topics = self._parse_betafile(beta_file, dtype)
+            word_topics = np.ascontiguousarray(topics.T)
+            del topics
+            if not Cache.save_array(cache_file, key, word_topics):
+                logging.warning('keeping topics of "{beta}" in memory'.format(
+                    beta=beta_file))
+                return word_topics
+            word_topics = Cache.load_array(cache_file, key)
+        self.word_topics_file = cache_file
+        return word_topics
+
+
+    def _parse_betafile(self, beta_file, dtype):
+        """
+        Parses the beta_file topic by topic into a topics x words matrix of
+        type /dtype/. Raises a ValueError if a line holds something else than
+        one number per word of the vocabulary.
+        """
+        n_words = len(self.vocab)
         try:
             with open(beta_file, 'r') as bfile:
-                #create first array entry
-                topic_no = 0
-                topic = bfile.readline()
-                topic = map(float, topic.split())
-                topics = scipy.array(topic)
-
-                #add the rest of the topics to the array
-                for topic in bfile:
-                    topic = map(float, topic.split())
-                    topics = scipy.vstack((topics,topic)) #append line
+                n_topics = sum(1 for line in bfile if line.strip())
+                if not n_topics:
+                    raise ValueError('"{beta}" is not a valid beta file: no '
+                            'topics'.format(beta=beta_file))
+                topics = np.empty((n_topics, n_words), dtype=dtype)
+                bfile.seek(0)
+                k = 0
+                for line in bfile:
+                    if not line.strip():
+                        continue
+                    #fromstring stops at the first value it cannot parse
+                    row = np.fromstring(line, dtype=dtype, sep=' ')
+                    if row.size != n_words:
+                        raise ValueError('"{beta}" is not a valid beta file: '
+                                'topic {k} has {n} numbers, the vocabulary {v} '
+                                'words'.format(beta=beta_file, k=k, n=row.size,
+                                    v=n_words))
+                    topics[k] = row
+                    k += 1
         except IOError as e:
-            logging.ERROR(e)
+            logging.error(e)
             raise
-
         return topics
 
 
-    def _create_word_id_dict(self):
-        """Returns a dictionary mapping words to their IDs"""
-        word_id_dict = {}
-        for w_id, word in enumerate(self.vocab):
-            word_id_dict[word] = w_id
-        return word_id_dict
+    def top_topic_words(self, nwords = 10):
+        """
+        Returns the /nwords/ highest ranked words in each topic. The result is
+        kept for later calls with the same /nwords/.
+        """
+        if nwords not in self._top_topic_words:
+            self._top_topic_words[nwords] = self._find_top_topic_words(nwords)
+        return [list(topic_res) for topic_res in self._top_topic_words[nwords]]
 
 
-    def top_topic_words(self, nwords = 10):
-        """Returns the /nwords/ highest ranked words in each topic."""
-        topic_no = 0
-        indices = range(len(self.vocab))
+    def _find_top_topic_words(self, nwords):
+        """
+        Selects the /nwords/ highest ranked words of a block of topics at once
+        and only sorts those. A block holds about a million values, so a
+        memory-mapped model is not read into memory as a whole.
+        """
+        n_topics, n_words = self.topics.shape
+        nwords = min(nwords, n_words)
+        if nwords == 0:
+            return [[] for topic in range(n_topics)]
+        block_size = max(1, (1 << 20) // n_words)
         res = []
-        for topic in self.topics:
-            #sort word indices by topic values
-            indices.sort(lambda x,y: -cmp(topic[x], topic[y]))
-            topic_res = []
-            for ii in range(nwords):
-                topic_res.append(self.vocab[indices[ii]])
-            res.append(topic_res)
-            topic_no += 1
+        for start in range(0, n_topics, block_size):
+            block = np.asarray(self.topics[start:start+block_size])
+            rows = np.arange(len(block))[:, np.newaxis]
+            #unsorted indices of the nwords largest values per topic
+            top = np.argpartition(block, -nwords, axis=1)[:, -nwords:]
+            order = np.argsort(-block[rows, top], axis=1, kind='mergesort')
+            top = top[rows, order]
+            res.extend([self.vocab[w_id] for w_id in topic_top]
+                    for topic_top in top)
         return res
 
 
+    def normalized_word_topics(self):
+        """
+        Returns the topic vectors of all words (one line per word), each
+        normalized to a range between 0 and 1. The matrix is computed on first
+        use and kept for later calls.
+        """
+        if self._normalized_word_topics is None:
+            word_topics = np.asarray(self.word_topics, dtype=np.float64)
+            v_min = word_topics.min(axis=1)[:, np.newaxis]
+            v_max = word_topics.max(axis=1)[:, np.newaxis]
+            self._normalized_word_topics = (word_topics - v_min) / (v_max - v_min)
+        return self._normalized_word_topics
+
+
     def get_topic_vector_for_id(self, word_id):
         """
         Looks up the index of the given /word/ in the /vocab/ array in order to
         return the topic vector found in the /topic_word_matrix/
         """
-        return self.topics[:,word_id]
+        return self.word_topics[word_id]
 
 
     def get_topic_vector_for_word(self, word):
@@ -111,8 +257,94 @@ class TopicModel:
         Looks up the index of the given /word/ in the /vocab/ array in order to
         return the topic vector found in the /topic_word_matrix/
         """
-        try:
-            ind = self.vocab.index(word) #get word's id
-        except ValueError:
+        ind = self.vocab.get(word) #get word's id
+        if ind is None:
             return None
-        return self.topics[:,ind]
+        return self.word_topics[ind]
+
+
+class Vocabulary:
+    """
+    The words of a topic model, stored as one sorted array of utf-8 encoded
+    words and the ids in that order. Words are looked up with a binary
+    search; ids() looks up many words at once. Needs far less memory than a
+    dictionary of strings and can be memory-mapped from a cache file.
+    """
+
+    def __init__(self, words, order):
+        #the sorted words
+        self.words = words
+        #the id of each word in words
+        self.order = order
+        #the position of each id in words
+        self.rank = np.empty(len(order), dtype=np.int32)
+        self.rank[order] = np.arange(len(order), dtype=np.int32)
+
+
+    @staticmethod
+    def create_index(vocab):
+        """
+        Returns the sorted array of the words in /vocab/ (utf-8 encoded,
+        ordered by id) and the id of each of them. The array is one byte
+        wider than the longest word, so longer words are never cut to a word
+        of the vocabulary when they are looked up.
+        """
+        width = max([len(word) for word in vocab] + [0]) + 1
+        words = np.array(vocab, dtype='S{width}'.format(width=width))
+        #a stable sort keeps equal words ordered by id
+        order = np.argsort(words, kind='mergesort').astype(np.int32)
+        return words[order], order
+
+
+    def __len__(self):
+        return len(self.words)
+
+
+    def __getitem__(self, w_id):
+        """Returns the word with id /w_id/."""
+        return self.words[self.rank[w_id]].decode('utf-8')
+
+
+    def __iter__(self):
+        """Yields the words ordered by id."""
+        for w_id in range(len(self.words)):
+            yield self[w_id]
+
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+
+    def get(self, word, default=None):
+        """Returns the id of /word/ or /default/ if it is unknown."""
+        w_id = self.ids([word])[0]
+        return default if w_id == -1 else int(w_id)
+
+
+    def ids(self, words):
+        """
+        Returns the ids of /words/ as an array, -1 for unknown words. Like in
+        a dictionary, the last id counts if a word occurs more than once in
+        the vocabulary.
+        """
+        keys = np.array(_encode_words(words), dtype=self.words.dtype)
+        if len(keys) == 0 or len(self.words) == 0:
+            return np.repeat(np.int32(-1), len(keys))
+        pos = np.searchsorted(self.words, keys, side='right') - 1
+        ids = self.order[pos]
+        ids[(pos == -1) | (self.words[pos] != keys)] = -1
+        return ids
+
+
+def _encode_words(words):
+    """Returns /words/ utf-8 encoded, all at once if possible."""
+    try:
+        #one join is much faster than encoding word by word
+        encoded = '\n'.join(words).encode('utf-8').split(b'\n')
+        if len(encoded) == len(words):
+            return encoded
+    except UnicodeDecodeError:
+        #mix of unicode and encoded words
+        pass
+    return [word.encode('utf-8') if isinstance(word, unicode) else word
+            for word in words]
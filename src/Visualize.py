@@ -1,17 +1,34 @@
+from __future__ import unicode_literals
+
 from matplotlib.path import Path
 from matplotlib.spines import Spine
 from matplotlib.projections.polar import PolarAxes
 from matplotlib.projections import register_projection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_hex
+from matplotlib.figure import Figure
 
 from itertools import cycle
+from xml.sax.saxutils import escape
 
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
+import collections
+import io
+import json
 import logging
+import multiprocessing
 import os
 import errno
 
+#projections registered by radar_projection: (num_vars, frame) -> (name, theta)
+_RADAR_PROJECTIONS = {}
+
+#colors of the clusters in a radar chart, repeated for more clusters
+COLORS = ['b', 'r', 'g', 'm', 'y']
+
 
 def mkdir_p(path):
     path = os.path.dirname(os.path.abspath(path))
@@ -24,7 +41,7 @@ def mkdir_p(path):
 
 #the code for radar_factory is not from me, I found it here:
 #http://matplotlib.org/examples/api/radar_chart.html
-def radar_factory(num_vars, frame='circle'):
+def radar_factory(num_vars, frame='circle', name='radar'):
     """Create a radar chart with `num_vars` axes.
 
     This function creates a RadarAxes projection and registers it.
@@ -35,12 +52,11 @@ def radar_factory(num_vars, frame='circle'):
         Number of variables for radar chart.
     frame : {'circle' | 'polygon'}
         Shape of frame surrounding axes.
+    name : string
+        Name the projection is registered with.
 
     """
-    # calculate evenly-spaced axis angles
-    theta = 2*np.pi * np.linspace(0, 1-1./num_vars, num_vars)
-    # rotate theta such that the first axis is at the top
-    theta += np.pi/2
+    theta = radar_theta(num_vars)
 
     def draw_poly_patch(self):
         verts = unit_poly_verts(theta)
@@ -56,7 +72,6 @@ def radar_factory(num_vars, frame='circle'):
 
     class RadarAxes(PolarAxes):
 
-        name = 'radar'
         # use 1 line segment to connect specified points
         RESOLUTION = 1
         # define draw_frame method
@@ -104,10 +119,32 @@ def radar_factory(num_vars, frame='circle'):
             spine.set_transform(self.transAxes)
             return {'polar': spine}
 
+    RadarAxes.name = name
     register_projection(RadarAxes)
     return theta
 
 
+def radar_theta(num_vars):
+    """Returns the angles of /num_vars/ axes of a radar chart."""
+    # calculate evenly-spaced axis angles
+    theta = 2*np.pi * np.linspace(0, 1-1./num_vars, num_vars)
+    # rotate theta such that the first axis is at the top
+    theta += np.pi/2
+    return theta
+
+
+def radar_projection(num_vars, frame='polygon'):
+    """
+    Returns the name of a registered radar projection with /num_vars/ axes
+    and its angles, see radar_factory. Each projection is only created once.
+    """
+    key = (num_vars, frame)
+    if key not in _RADAR_PROJECTIONS:
+        name = 'radar_{frame}_{n}'.format(frame=frame, n=num_vars)
+        _RADAR_PROJECTIONS[key] = (name, radar_factory(num_vars, frame, name))
+    return _RADAR_PROJECTIONS[key]
+
+
 def unit_poly_verts(theta):
     """Return vertices of polygon for subplot axes.
 
@@ -118,29 +155,13 @@ def unit_poly_verts(theta):
     return verts
 
 
-def create_radar_chart(title, clusters, column_names, fname='', plot=True):
+def draw_radar_chart(ax, theta, title, clusters, column_names):
     """
-    Plots a radar chart.
-    
-    title: string
-    clusters: dictionary {cluster_name:scipy.ndarray}
-        centroids of clusters
-    column_names: list of strings
-        labels for the axes
+    Draws the radar chart of the /clusters/ into the radar axes /ax/ with
+    the angles /theta/, see create_radar_chart.
     """
-    #this is a fix for bigger fonts at the topN topic words
-    plt.rcParams.update({'font.size': 20})
-
-    N = clusters.values()[0].shape[1] #number of axes for the radar chart
-    theta = radar_factory(N, frame='polygon')
+    cols = cycle(COLORS)
 
-    fig = plt.figure(figsize=(11, 11))
-    fig.subplots_adjust(wspace=0.25, hspace=0.20, top=0.9, bottom=0.05)
-
-    colors = ['b', 'r', 'g', 'm', 'y']
-    cols = cycle(colors)
-
-    ax = fig.add_subplot(111, projection='radar')
     ax.set_title(title, weight='bold', size='26', position=(0.08, 1.11),
                  horizontalalignment='center', verticalalignment='center')
 
@@ -155,17 +176,271 @@ def create_radar_chart(title, clusters, column_names, fname='', plot=True):
         labels.append(cluster_name)
     ax.set_varlabels(column_names)
 
-    legend = plt.legend(labels, loc=(0.78, 1.00), labelspacing=0.07)
+    legend = ax.legend(labels, loc=(0.78, 1.00), labelspacing=0.07)
     plt.setp(legend.get_texts(), fontsize='small')
+
+
+class RadarChartRenderer:
+    """
+    Saves radar charts without pyplot. A figure with radar axes is created
+    once per number of axes and cleared for the next chart, only the
+    /max_figures/ most recently used figures are kept. The font size is set
+    while rendering only, the global rcParams stay untouched. Call close to
+    free the figures.
+    """
+
+    def __init__(self, figsize=(11, 11), font_size=20, max_figures=4):
+        self.figsize = figsize
+        #this is a fix for bigger fonts at the topN topic words
+        self.rc = {'font.size': font_size}
+        self.max_figures = max_figures
+        self.figures = collections.OrderedDict()
+
+
+    def _get_axes(self, num_vars):
+        """Returns an empty figure with radar axes and their angles."""
+        figure = self.figures.pop(num_vars, None)
+        if figure is None:
+            projection, theta = radar_projection(num_vars, frame='polygon')
+            fig = Figure(figsize=self.figsize)
+            FigureCanvasAgg(fig)
+            fig.subplots_adjust(wspace=0.25, hspace=0.20, top=0.9, bottom=0.05)
+            ax = fig.add_subplot(111, projection=projection)
+            figure = (fig, ax, theta)
+        else:
+            figure[1].cla()
+        #mark as most recently used
+        self.figures[num_vars] = figure
+        while len(self.figures) > self.max_figures:
+            self.figures.popitem(last=False)[1][0].clf()
+        return figure
+
+
+    def save(self, title, clusters, column_names, fname):
+        """Saves the radar chart of the /clusters/ to /fname/."""
+        with matplotlib.rc_context(self.rc):
+            num_vars = clusters.values()[0].shape[1]
+            fig, ax, theta = self._get_axes(num_vars)
+            draw_radar_chart(ax, theta, title, clusters, column_names)
+            fig.savefig(fname)
+
+
+    def close(self):
+        """Frees the figures."""
+        for fig, _, _ in self.figures.itervalues():
+            fig.clf()
+        self.figures.clear()
+
+
+#renders the charts of save_radar_chart
+RENDERER = RadarChartRenderer()
+
+
+class ChartPool:
+    """
+    Saves radar charts in /processes/ background processes, so the caller
+    can go on while they are rendered. At most /max_pending/ charts (default
+    twice the processes) are queued or rendered at once; save waits for the
+    oldest one to finish before queueing more, which bounds the memory held
+    by the queue. Call close to wait for all charts.
+    """
+
+    def __init__(self, processes, max_pending=None):
+        self.pool = multiprocessing.Pool(processes)
+        self.max_pending = max_pending or 2 * processes
+        self.pending = collections.deque()
+
+
+    def save(self, title, clusters, column_names, fname):
+        """Queues the radar chart of the /clusters/ to be saved to /fname/."""
+        while len(self.pending) >= self.max_pending:
+            self._wait()
+        result = self.pool.apply_async(_save_chart,
+                (title, clusters, column_names, fname))
+        self.pending.append((fname, result))
+
+
+    def _wait(self):
+        """Waits for the oldest queued chart."""
+        fname, result = self.pending.popleft()
+        try:
+            result.get()
+        except Exception as e:
+            logging.error('could not save "{name}": {err}'.format(name=fname,
+                err=e))
+
+
+    def close(self):
+        """Waits for all queued charts and stops the processes."""
+        try:
+            while self.pending:
+                self._wait()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def _save_chart(title, clusters, column_names, fname):
+    RENDERER.save(title, clusters, column_names, fname)
+
+
+def radar_chart_svg(title, clusters, column_names, size=800, rings=5):
+    """
+    Returns the radar chart of the /clusters/ (see create_radar_chart) as an
+    SVG document of /size/ x /size/ pixels, computed directly from the
+    geometry of the axes instead of rendering it with matplotlib. The
+    radius of the frame is the largest value, /rings/ grid lines divide it.
+    """
+    vectors = [np.asarray(vector, dtype=float).flatten()
+            for vector in clusters.values()]
+    theta = radar_theta(len(vectors[0]))
+    r_min = min(0., min(vector.min() for vector in vectors))
+    r_max = max(vector.max() for vector in vectors)
+    if r_max <= r_min:
+        r_max = r_min + 1.
+    #the frame is the polygon circumscribed by a circle of /radius/
+    radius = 0.3 * size
+    cx, cy = 0.5 * size, 0.55 * size
+
+    def point(x, y, scale=1.):
+        #axes coordinates of unit_poly_verts, y points up
+        return (cx + (x - 0.5) * 2 * radius * scale,
+                cy - (y - 0.5) * 2 * radius * scale)
+
+    def to_svg(verts, scale=1.):
+        return ' '.join('{0:.2f},{1:.2f}'.format(*point(x, y, scale))
+                for x, y in verts)
+
+    def text(x, y, label, anchor='middle', attributes=''):
+        lines = label.split('\n')
+        #center the lines vertically around y
+        spans = ''.join('<tspan x="{x:.2f}" dy="{dy}em">{line}</tspan>'.format(
+            x=x, dy=-0.6 * (len(lines) - 1) + 0.35 if i == 0 else 1.2,
+            line=escape(line)) for i, line in enumerate(lines))
+        return ('<text x="{x:.2f}" y="{y:.2f}" text-anchor="{anchor}"{attr}>'
+                '{spans}</text>'.format(x=x, y=y, anchor=anchor,
+                    attr=attributes, spans=spans))
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{0}" '
+            'viewBox="0 0 {0} {0}" font-family="sans-serif" '
+            'font-size="{1:.1f}">'.format(size, size / 55.),
+            '<rect width="100%" height="100%" fill="white"/>',
+            text(0.5 * size, 0.05 * size, title,
+                attributes=' font-size="{0:.1f}" font-weight="bold"'.format(
+                    size / 42.))]
+    #frame, grid and axes
+    frame = unit_poly_verts(theta)
+    for ring in xrange(1, rings + 1):
+        svg.append('<polygon points="{points}" fill="none" stroke="{color}" '
+                'stroke-width="{width}"/>'.format(points=to_svg(frame,
+                    float(ring) / rings), color='black' if ring == rings
+                    else '#b0b0b0', width=1 if ring == rings else 0.5))
+        value = r_min + (r_max - r_min) * ring / rings
+        x, y = point(frame[0][0], frame[0][1], float(ring) / rings)
+        svg.append(text(x + 4, y, '{0:.2g}'.format(value), anchor='start',
+            attributes=' fill="#808080" font-size="{0:.1f}"'.format(size / 80.)))
+    for t, label in zip(theta, column_names):
+        svg.append('<line x1="{0:.2f}" y1="{1:.2f}" x2="{2:.2f}" y2="{3:.2f}" '
+                'stroke="#b0b0b0" stroke-width="0.5"/>'.format(cx, cy,
+                    cx + radius * np.cos(t), cy - radius * np.sin(t)))
+        cos = np.cos(t)
+        anchor = 'start' if cos > 0.1 else 'end' if cos < -0.1 else 'middle'
+        svg.append(text(cx + 1.12 * radius * cos,
+            cy - 1.12 * radius * np.sin(t), label, anchor=anchor))
+    #clusters and legend
+    for i, (name, vector, color) in enumerate(zip(clusters.keys(), vectors,
+            cycle(COLORS))):
+        color = to_hex(color)
+        scale = (vector - r_min) / (r_max - r_min)
+        points = ' '.join('{0:.2f},{1:.2f}'.format(cx + radius * r * np.cos(t),
+            cy - radius * r * np.sin(t)) for r, t in zip(scale, theta))
+        svg.append('<polygon points="{points}" fill="{color}" '
+                'fill-opacity="0.1" stroke="{color}" stroke-width="1.5">'
+                '<title>{name}</title></polygon>'.format(points=points,
+                    color=color, name=escape(name)))
+        y = 0.04 * size + i * size / 45.
+        svg.append('<rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" '
+                'height="{w:.2f}" fill="{color}"/>'.format(x=0.8 * size,
+                    y=y - size / 120., w=size / 60., color=color))
+        svg.append(text(0.8 * size + size / 40., y, name, anchor='start'))
+    svg.append('</svg>')
+    return '\n'.join(svg) + '\n'
+
+
+def radar_chart_json(title, clusters, column_names):
+    """
+    Returns the data of a radar chart (see create_radar_chart) as a
+    dictionary to be drawn elsewhere: the title, the axis labels and their
+    angles and the name, color and values of each cluster.
+    """
+    return {'title': title,
+            'axes': list(column_names),
+            'theta': radar_theta(len(column_names)).tolist(),
+            'clusters': [{'name': name, 'color': to_hex(color),
+                'values': np.asarray(vector, dtype=float).flatten().tolist()}
+                for (name, vector), color in zip(clusters.items(),
+                    cycle(COLORS))]}
+
+
+def save_radar_chart_svg(title, clusters, column_names, fname):
+    """Saves the radar chart as SVG to /fname/, see radar_chart_svg."""
+    with io.open(fname, 'w', encoding='utf-8') as svg_file:
+        svg_file.write(radar_chart_svg(title, clusters, column_names))
+
+
+def save_radar_chart_json(title, clusters, column_names, fname):
+    """Saves the data of the radar chart to /fname/, see radar_chart_json."""
+    with open(fname, 'w') as json_file:
+        json.dump(radar_chart_json(title, clusters, column_names), json_file,
+                separators=(',', ':'))
+
+
+#charts written without matplotlib by the extension of the file
+CHART_WRITERS = {'.svg': save_radar_chart_svg, '.json': save_radar_chart_json}
+
+
+def create_radar_chart(title, clusters, column_names, fname='', plot=True,
+        renderer=None):
+    """
+    Plots a radar chart.
+    
+    title: string
+    clusters: dictionary {cluster_name:scipy.ndarray}
+        centroids of clusters
+    column_names: list of strings
+        labels for the axes
+    renderer: RadarChartRenderer or ChartPool
+        saves the chart to fname, default is RENDERER. Files ending with
+        .svg or .json are written without it, see CHART_WRITERS
+    """
     if fname:
         print('saving "{name}"'.format(name=fname))
         mkdir_p(fname)
-        plt.savefig(fname)
-    if plot:
+        writer = CHART_WRITERS.get(os.path.splitext(fname)[1].lower())
+        if writer is not None:
+            writer(title, clusters, column_names, fname)
+        else:
+            if renderer is None:
+                renderer = RENDERER
+            renderer.save(title, clusters, column_names, fname)
+    if not plot:
+        return
+
+    with matplotlib.rc_context(RENDERER.rc):
+        N = clusters.values()[0].shape[1] #number of axes for the radar chart
+        projection, theta = radar_projection(N, frame='polygon')
+
+        fig = plt.figure(figsize=RENDERER.figsize)
+        fig.subplots_adjust(wspace=0.25, hspace=0.20, top=0.9, bottom=0.05)
+        ax = fig.add_subplot(111, projection=projection)
+        draw_radar_chart(ax, theta, title, clusters, column_names)
         plt.show()
+    plt.close(fig)
 
 def plot_radar_chart(title, clusters, column_names):
     create_radar_chart(title,clusters, column_names)
 
-def save_radar_chart(title, clusters, column_names, fname, plot=False):
-    create_radar_chart(title, clusters, column_names, fname=fname, plot=plot)
+def save_radar_chart(title, clusters, column_names, fname, plot=False,
+        renderer=None):
+    create_radar_chart(title, clusters, column_names, fname=fname, plot=plot,
+            renderer=renderer)
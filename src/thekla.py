@@ -20,16 +20,25 @@ __copyright__ = '© Copyright 2011 Johannes Knopp'
 
 from TopicModel import TopicModel as TM
 from Document import Documents as DOCS
+import Cache
+import Profile
 import Visualize
 import Clustering
 
+import collections
+import itertools
 import logging
+import multiprocessing
 import optparse
 import ConfigParser
 import sys
 import json
 import os
 import codecs
+import io
+import re
+
+import numpy as np
 
 #the global logger
 LOG = logging.getLogger()
@@ -37,7 +46,11 @@ LOG.setLevel(logging.DEBUG)
 
 EXAMPLECONF = '../example/example.conf'
 DEFAULTS = {'centroid_computation':'avg', 'cluster_algorithm':'dbscan',
-            'nwords':'5'}
+            'nwords':'5', 'dtype':'float64', 'cache':'true',
+            'storage':'memory', 'workers':'1', 'cluster_space':'distances',
+            'eps_error':'0.01',
+            'drift_threshold':'0.5', 'cluster_centroid':'avg',
+            'format':'png'}
 
 
 def init_optionparser():
@@ -61,6 +74,38 @@ def init_optionparser():
         help='Print debug output [default: %default]'
         )
 
+    parser.add_option('-j', '--jobs',
+        default=1,
+        type='int',
+        dest='jobs',
+        help='Number of configs processed in parallel [default: %default]'
+        )
+
+    parser.add_option('--render-jobs',
+        default=0,
+        type='int',
+        dest='render_jobs',
+        help='Number of processes saving the charts in the background while '
+        'the next config is processed, 0 saves them right away. Not used '
+        'with -j [default: %default]'
+        )
+
+    parser.add_option('--render-queue',
+        default=None,
+        type='int',
+        dest='render_queue',
+        help='Maximum number of charts waiting to be saved by the '
+        'render jobs [default: twice the render jobs]'
+        )
+
+    parser.add_option('--profile',
+        default=False,
+        action='store_true',
+        dest='profile',
+        help='Log the time and memory used by each stage and write them to '
+        '{title}.profile.json in the res_dir [default: %default]'
+        )
+
     #Logging related options
     log_options = optparse.OptionGroup(parser,
             'Logging',
@@ -117,75 +162,468 @@ def init_logging(options):
     LOG.debug('Logging initialised')
 
 
-def load_topic_model(config):
-    """Loads a topic model."""
+class SharedData:
+    """
+    Topic models and represented documents that are shared between the
+    configs of a batch run, so configs referring to the same files only load
+    them once. Only the /max_documents/ most recently used document sets are
+    kept.
+    """
+
+    def __init__(self, max_documents=4, allow_workers=True):
+        self.models = {}
+        self.documents = collections.OrderedDict()
+        self.max_documents = max_documents
+        #processes in a pool must not start pools themselves
+        self.allow_workers = allow_workers
+
+
+    def get_documents(self, key):
+        """Returns the documents stored for /key/ or None."""
+        documents = self.documents.pop(key, None)
+        if documents is None:
+            return None
+        #mark as most recently used
+        self.documents[key] = documents
+        #forget the clustering of the previous config
+        documents.reset_cluster_assignments()
+        #nothing is read for this config
+        documents.counts = dict.fromkeys(documents.counts, 0)
+        return documents
+
+
+    def add_documents(self, key, documents):
+        self.documents[key] = documents
+        while len(self.documents) > self.max_documents:
+            self.documents.popitem(last=False)
+
+
+def load_topic_model(config, shared=None):
+    """Loads a topic model or reuses it from /shared/."""
     vfile = config.get('topicmodel', 'vocabfile')
     bfile = config.get('topicmodel', 'betafile')
+    dtype = config.get('topicmodel', 'dtype')
+    cache = config.getboolean('topicmodel', 'cache')
+    storage = config.get('topicmodel', 'storage')
+    key = (os.path.abspath(vfile), os.path.abspath(bfile), dtype, storage)
+    if shared and key in shared.models:
+        LOG.info('reusing topic model from "{file}"'.format(file=bfile))
+        return shared.models[key]
     LOG.info('loading topic model from "{file}"..'.format(file=bfile))
     if not os.path.exists(bfile):
         LOG.error('file {file} does not exist'.format(file=bfile))
         return None
-    tm = TM(vfile, bfile)
+    tm = TM(vfile, bfile, dtype=dtype, cache=cache, storage=storage)
+    if shared:
+        shared.models[key] = tm
     LOG.info('done')
     return tm
 
 
-def represent_documents(config, tm):
-    """Loads the documents and represents them using a tm."""
+def represent_documents(config, tm, shared=None, callback=None):
+    """
+    Loads the documents and represents them using a tm. /callback/ gets
+    the centroids of each batch of documents, see Documents.
+    """
     doc_dir = config.get('documents', 'docdir')
     centroid_computation = config.get('documents', 'centroid_computation')
+    key = ('dir', os.path.abspath(doc_dir), tm.fingerprint,
+            centroid_computation) + document_storage(config)
+    documents = shared.get_documents(key) if shared else None
+    if documents is not None:
+        LOG.info('reusing documents from "{doc}"'.format(doc=doc_dir))
+        return documents
+    workers = document_workers(config, shared)
+    cache = open_centroid_cache(config)
     LOG.info('representing documents from "{doc}" with topics..'.format(doc=doc_dir))
-    documents = DOCS(doc_dir, tm, centroid_computation)
+    documents = DOCS(doc_dir, tm, centroid_computation, workers, cache,
+            callback, document_centroid_file(config))
+    if cache:
+        cache.close()
+    if shared:
+        shared.add_documents(key, documents)
     LOG.info('done')
     return documents
 
 
-def represent_documents_from_files(config, tm, files):
+def represent_documents_from_files(config, tm, files, shared=None):
     """Loads the documents and represents them using a tm."""
     centroid_computation = config.get('documents', 'centroid_computation')
+    key = ('files', frozenset(files), tm.fingerprint,
+            centroid_computation) + document_storage(config)
+    documents = shared.get_documents(key) if shared else None
+    if documents is not None:
+        LOG.info('reusing {doccount} documents'.format(doccount=len(files)))
+        return documents
+    workers = document_workers(config, shared)
+    cache = open_centroid_cache(config)
     LOG.info('representing {doccount} documents with topics..'.format(doccount=len(files)))
-    documents = DOCS(files, tm, centroid_computation)
+    documents = DOCS(files, tm, centroid_computation, workers, cache,
+            centroid_file=document_centroid_file(config))
+    if cache:
+        cache.close()
+    if shared:
+        shared.add_documents(key, documents)
     LOG.info('done')
     return documents
 
 
-def load_clustering(config, clustering_title):
-    """Loads a config file containing document clusters."""
-    cluster_file = config.get('clustering', 'clusterfile')
-    LOG.info('loading clusters from "{file}"..'.format(file=cluster_file))
-    clustering = ConfigParser.ConfigParser()
-    clustering.read(cluster_file)
-    clusters = {}
-    for sec in clustering.sections():
-        #must be absolute filenames
-        doc_filenames = json.loads(clustering.get(sec, 'docs'))
-        clusters[sec] = doc_filenames
-    LOG.info('done')
-    return clusters
+def document_storage(config):
+    """
+    Returns the options that decide how documents are represented and where
+    their centroids are written, for the keys of shared documents: configs
+    with another centroidfile or cachefile must write their own files.
+    """
+    files = []
+    for option in ('centroidfile', 'cachefile'):
+        if config.has_option('documents', option):
+            files.append(os.path.abspath(config.get('documents', option)))
+        else:
+            files.append(None)
+    return tuple(files) + (config.getint('documents', 'workers'),)
+
+
+def document_workers(config, shared=None):
+    """Returns the number of processes used to represent documents."""
+    workers = config.getint('documents', 'workers')
+    if shared and not shared.allow_workers and workers > 1:
+        LOG.debug('representing documents in one process inside a batch job')
+        return 1
+    return workers
+
+
+def open_centroid_cache(config):
+    """Returns the document centroid cache given in the config or None."""
+    if not config.has_option('documents', 'cachefile'):
+        return None
+    cache_file = config.get('documents', 'cachefile')
+    LOG.debug('using centroid cache "{file}"'.format(file=cache_file))
+    return Cache.CentroidCache(cache_file)
+
+
+def document_centroid_file(config):
+    """
+    Returns the file the document centroids are kept in instead of memory or
+    None.
+    """
+    if not config.has_option('documents', 'centroidfile'):
+        return None
+    return config.get('documents', 'centroidfile')
 
 
-def create_cluster_centroids(clusters, documents):
+def load_clustering(config, clustering_title, option='clusterfile'):
+    """
+    Loads a file containing document clusters. Returns the clusters and the
+    list of the documents in them, see read_cluster_file.
+    """
+    cluster_file = config.get('clustering', option)
+    LOG.info('loading clusters from "{file}"..'.format(file=cluster_file))
+    clusters, docnames = read_cluster_file(cluster_file)
+    LOG.info('done, {count} documents in {clusters} clusters'.format(
+        count=len(docnames), clusters=len(clusters)))
+    return clusters, docnames
+
+
+#option holding the documents of a cluster in a clusterfile section
+CLUSTER_OPTION = re.compile(r'^(?P<key>[^:=\s][^:=]*?)\s*[:=]\s*(?P<value>.*)$')
+
+def read_cluster_file(cluster_file):
+    """
+    Returns the clusters {cluster_name : [documents]} in /cluster_file/ and
+    the list of all documents in them, each listed once. A document that is
+    in several clusters is the same string object in all of them.
+
+    The file is read line by line. It is either a clusterfile with one
+    section per cluster (see README) or a file with one document per line,
+    given as the cluster name and the document separated by a tab.
+    """
+    try:
+        cfile = io.open(cluster_file, 'r', encoding='utf-8')
+    except IOError as e:
+        LOG.error(e)
+        return {}, []
+    paths = {}
+    known_path = paths.setdefault
+    clusters = {}
+    with cfile:
+        for name, docs in _iter_cluster_file(cfile):
+            cluster = clusters.setdefault(name, [])
+            cluster.extend([known_path(doc, doc) for doc in docs])
+    return clusters, list(paths)
+
+
+def _iter_cluster_file(lines):
+    """
+    Yields (cluster_name, [documents]) for the clusters given in /lines/, in
+    one of the formats of read_cluster_file.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.strip() and line[0] not in '#;':
+            break
+    else:
+        return
+    #the first line that is not a comment tells the format
+    if line[0] == '[':
+        clusters = _iter_cluster_sections(line, lines)
+    else:
+        clusters = _iter_cluster_lines(line, lines)
+    for res in clusters:
+        yield res
+
+
+def _iter_cluster_sections(first, lines):
+    """
+    Yields (cluster_name, [documents]) for every section of a clusterfile,
+    starting with the header /first/. Like ConfigParser, values continue
+    on indented lines.
+    """
+    name = None
+    value = None
+    for line in itertools.chain([first], lines):
+        stripped = line.strip()
+        if not stripped or line[0] in '#;':
+            continue
+        if line[0].isspace():
+            if value is not None:
+                value.append(stripped)
+            continue
+        if value is not None:
+            yield name, _parse_cluster_docs('\n'.join(value))
+            value = None
+        if line[0] == '[':
+            name = stripped[1:stripped.index(']')]
+            continue
+        match = CLUSTER_OPTION.match(stripped)
+        if match is None:
+            raise ValueError('invalid line in clusterfile: {line}'.format(
+                line=stripped))
+        if match.group('key').lower() == 'docs' and name is not None:
+            #must be absolute filenames
+            value = [match.group('value')]
+    if value is not None:
+        yield name, _parse_cluster_docs('\n'.join(value))
+
+
+def _parse_cluster_docs(value):
+    """
+    Returns the JSON list of documents in /value/. Comments starting with
+    ';' or '#' after the list are ignored, ConfigParser dropped them too.
+    """
+    #the list may start on the line after the option
+    value = value.lstrip()
+    docs, end = json.JSONDecoder().raw_decode(value)
+    rest = value[end:].strip()
+    if rest and rest[0] not in '#;':
+        raise ValueError('invalid documents in clusterfile: {value}'.format(
+            value=value))
+    return docs
+
+
+def _iter_cluster_lines(first, lines):
+    """
+    Yields (cluster_name, [documents]) for the lines
+    "cluster_name<TAB>document", starting with line /first/. Consecutive
+    lines of the same cluster are yielded together.
+    """
+    name = None
+    docs = []
+    for line in itertools.chain([first], lines):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line[0] == '#':
+            continue
+        line_name, sep, doc = line.partition('\t')
+        if not sep:
+            raise ValueError('invalid line in clusterfile: {line}'.format(
+                line=line))
+        if line_name != name:
+            if docs:
+                yield name, docs
+            name = line_name
+            docs = []
+        docs.append(doc)
+    if docs:
+        yield name, docs
+
+
+def save_clustering(config, clusters, documents, centers=None):
+    """
+    Writes the clusters to the file given as save_clusterfile, in the format
+    of a clusterfile. Files ending with .tsv get one line per document
+    instead, see read_cluster_file. The centroids of the clusters and the
+    /documents/ in none of them are stored as well, see save_cluster_state.
+    """
+    if not config.has_option('clustering', 'save_clusterfile'):
+        return
+    cluster_file = config.get('clustering', 'save_clusterfile')
+    LOG.info('saving clusters to "{file}"'.format(file=cluster_file))
+    with codecs.open(cluster_file, 'w', 'utf-8') as cfile:
+        for name in sorted(clusters):
+            if cluster_file.endswith('.tsv'):
+                cfile.write(''.join('{name}\t{doc}\n'.format(name=name,
+                    doc=doc) for doc in clusters[name]))
+            else:
+                cfile.write('[{name}]\ndocs: {docs}\n\n'.format(name=name,
+                    docs=json.dumps(clusters[name])))
+    save_cluster_state(cluster_file, clusters, documents, centers)
+
+
+def cluster_state_files(cluster_file):
+    """
+    Returns the files next to /cluster_file/ that hold the centroids of its
+    clusters and the documents that are in none of them.
+    """
+    return cluster_file + '.centroids.npy', cluster_file + '.noise'
+
+
+def _cluster_state_key(cluster_file, noise_file, names, tm):
+    return {'clusters': Cache.source_key(cluster_file),
+            'noise': Cache.source_key(noise_file),
+            'model': tm.fingerprint, 'names': sorted(names)}
+
+
+def save_cluster_state(cluster_file, clusters, documents, centers=None):
+    """
+    Stores the average centroid of each cluster and the documents that are
+    in no cluster (e.g. dbscan's noise) next to /cluster_file/, so
+    update_clustering can measure the drift against the saved centroids and
+    leaves those documents unclustered. Clusters in /centers/ ({cluster_name :
+    centroid}, see update_clusters) keep that centroid instead, so updates
+    are measured against the clustering they started from.
+    """
+    centroid_file, noise_file = cluster_state_files(cluster_file)
+    names = sorted(clusters)
+    in_cluster = np.zeros(len(documents), dtype=bool)
+    for name in names:
+        rows = documents.lookup(clusters[name])
+        in_cluster[rows[rows != -1]] = True
+    try:
+        with open(noise_file, 'wb') as nfile:
+            nfile.write(b''.join(path + b'\n'
+                for path in documents.paths[~in_cluster]))
+    except IOError as e:
+        LOG.warning('could not save the documents without cluster: {err}'.format(
+            err=e))
+        return
+    centers = centers or {}
+    cluster_centroids = documents.compute_cluster_centroids(
+            dict((name, clusters[name]) for name in names
+                if name not in centers))
+    centroids = np.zeros((len(names), len(documents.tm)))
+    for k, name in enumerate(names):
+        if name in centers:
+            centroids[k] = np.ravel(centers[name])
+        else:
+            centroids[k] = cluster_centroids[name]
+    Cache.save_array(centroid_file, _cluster_state_key(cluster_file,
+        noise_file, names, documents.tm), centroids)
+
+
+def load_cluster_state(cluster_file, clusters, tm):
+    """
+    Returns the centroids {cluster_name : centroid} of the /clusters/ in
+    /cluster_file/ and the documents in none of them as stored by
+    save_cluster_state, or None and an empty list if they were not stored
+    for this clustering and topic model /tm/.
+    """
+    centroid_file, noise_file = cluster_state_files(cluster_file)
+    try:
+        key = _cluster_state_key(cluster_file, noise_file, clusters, tm)
+    except OSError:
+        return None, []
+    centroids = Cache.load_array(centroid_file, key)
+    if centroids is None:
+        return None, []
+    try:
+        with open(noise_file, 'rb') as nfile:
+            noise = [line.rstrip(b'\n') for line in nfile]
+    except IOError:
+        return None, []
+    return dict(zip(key['names'], centroids)), noise
+
+
+def update_clustering(documents, config, clustering_title):
+    """
+    Updates the clustering given as previous_clusterfile to the documents.
+    Returns the clusters and their centroids to save, see update_clusters,
+    or None, None if there is none or the clusters changed too much.
+    """
+    if not config.has_option('clustering', 'previous_clusterfile'):
+        return None, None
+    if not os.path.exists(config.get('clustering', 'previous_clusterfile')):
+        LOG.info('no previous clustering found')
+        return None, None
+    previous_file = config.get('clustering', 'previous_clusterfile')
+    previous, clustered = load_clustering(config, clustering_title,
+            'previous_clusterfile')
+    centers, noise = load_cluster_state(previous_file, previous, documents.tm)
+    if centers is None:
+        LOG.info('no cluster centroids saved with "{file}", measuring the '
+                'drift from the remaining documents'.format(file=previous_file))
+    rows = documents.lookup(clustered)
+    noise_rows = documents.lookup(noise)
+    noise_rows = noise_rows[noise_rows != -1]
+    #documents that were not clustered before count as new ones, the ones
+    #that could not be clustered stay unclustered
+    is_new = np.ones(len(documents), dtype=bool)
+    is_new[rows[rows != -1]] = False
+    is_new[noise_rows] = False
+    added = documents.paths[is_new].tolist()
+    removed = [doc for doc, row in zip(clustered, rows) if row == -1]
+    drift_threshold = config.getfloat('clustering', 'drift_threshold')
+    clusters, centers = Clustering.update_clusters(previous, documents, added,
+            removed, drift_threshold, centers)
+    if clusters is not None:
+        #label them like process_clustering does
+        documents.labels[noise_rows] = 0
+    return clusters, centers
+
+
+def create_cluster_centroids(clusters, documents, flavor='avg'):
     """Returns a dictionary {cluster_name : cluster_centroid}."""
     LOG.info('computing cluster centroids')
-    cluster_centroids= {}
-    for c_name, cluster in clusters.iteritems():
-        cluster_centroids[c_name] = documents.compute_cluster_centroid(cluster)
+    cluster_centroids = documents.compute_cluster_centroids(clusters, flavor)
     LOG.info('done')
     return cluster_centroids
 
 
-def create_clustering(documents, config):
-    """Returns a clustering of the documents."""
+def create_streaming_clusterer(config):
+    """
+    Returns a clusterer that can be updated while documents are represented
+    if the configured algorithm supports it, otherwise None.
+    """
+    cluster_alg = config.get('clustering', 'cluster_algorithm')
+    if cluster_alg != 'minibatch_kmeans':
+        return None
+    cluster_options = {}
+    if config.has_option('clustering', 'cluster_options'):
+        cluster_options = json.loads(config.get('clustering','cluster_options'))
+    return Clustering.StreamingKMeans(cluster_options)
+
+
+def create_clustering(documents, config, clusterer=None):
+    """
+    Returns a clustering of the documents. A /clusterer/ from
+    create_streaming_clusterer is used instead of clustering again.
+    """
     cluster_alg = config.get('clustering', 'cluster_algorithm')
+    cluster_space = config.get('clustering', 'cluster_space')
 
     #start dbscan and infer the options
     if cluster_alg == 'dbscan' and not config.has_option('clustering','cluster_options'):
-        clusters = Clustering.create_clusters_dbscan_infer_options(documents)
+        eps_statistic = None
+        if config.has_option('clustering', 'eps_statistic'):
+            eps_statistic = config.get('clustering', 'eps_statistic')
+        clusters = Clustering.create_clusters_dbscan_infer_options(documents,
+                cluster_space=cluster_space, eps_statistic=eps_statistic,
+                eps_error=config.getfloat('clustering', 'eps_error'))
     #use given options
     else:
-        cluster_options = json.loads(config.get('clustering','cluster_options'))
+        cluster_options = {}
+        if config.has_option('clustering', 'cluster_options'):
+            cluster_options = json.loads(config.get('clustering','cluster_options'))
         clusters = Clustering.create_clusters(documents, cluster_alg,
-                cluster_options)
+                cluster_options, cluster_space, clusterer)
     return clusters
 
 
@@ -196,19 +634,30 @@ def get_axis_labels(tm, nwords=5):
     return topic_top_words
 
 
-def visualize_clusters(config, tm, clustering_title, cluster_centroids):
-    """Create radar chart for the given clustering and save it to a file."""
+def visualize_clusters(config, tm, clustering_title, cluster_centroids,
+        renderer=None):
+    """
+    Create radar chart for the given clustering and save it to a file for
+    each configured format. A Visualize.ChartPool /renderer/ saves the
+    images rendered with matplotlib in the background.
+    """
     res_dir = config.get('visualization', 'res_dir')
     if not res_dir.endswith(os.sep):
         res_dir += os.sep
 
     nwords = config.getint('visualization', 'nwords')
     axis_labels = get_axis_labels(tm, nwords)
+    formats = [fmt.strip().lower()
+            for fmt in config.get('visualization', 'format').split(',')]
     #save the image
-    res_file = res_dir + '{title}.png'.format(title=clustering_title)
-    Visualize.save_radar_chart(clustering_title, cluster_centroids,
-            axis_labels,
-            fname=res_file)
+    for fmt in formats:
+        if not fmt:
+            continue
+        res_file = res_dir + '{title}.{fmt}'.format(title=clustering_title,
+                fmt=fmt)
+        Visualize.save_radar_chart(clustering_title, cluster_centroids,
+                axis_labels,
+                fname=res_file, renderer=renderer)
 
 
 def export_to_semeval_format(config, documents):
@@ -231,78 +680,187 @@ def export_to_semeval_format(config, documents):
         else:
             pos = 'v' #default
 
+    res_lines = []
+    for row in np.flatnonzero(documents.labels != -1):
+        assignment = documents.labels[row]
+        fname = documents.paths[row]
+        #fname example: /home/jknopp/code/thekla/example/data/deploy/deploy_1.txt
+        word = os.path.basename(fname).split('_')[0]
+        index = os.path.basename(fname).split('_')[1].split('.')[0]
+        res_line = '{w}.{pos} {w}.{pos}.{i} {w}.{pos}.{k}\n'.format(
+                w=word, i=index, k = assignment, pos=pos)
+        res_lines.append(res_line)
+    documents.reset_cluster_assignments() #reset clustering
+
+    #a single write keeps the lines of parallel jobs apart
     with codecs.open(semeval_res_file, 'a', 'utf-8') as rfile:
-        for doc in documents.docs.itervalues():
-            assignment = doc.cluster_assignment
-            if assignment == -1:
-                continue
-            #fname example: /home/jknopp/code/thekla/example/data/deploy/deploy_1.txt
-            word = os.path.basename(doc.fname).split('_')[0]
-            index = os.path.basename(doc.fname).split('_')[1].split('.')[0]
-            res_line = '{w}.{pos} {w}.{pos}.{i} {w}.{pos}.{k}\n'.format(
-                    w=word, i=index, k = assignment, pos=pos)
-            rfile.write(res_line)
-            doc.set_cluster_assignment(-1) #reset clustering
-
-
-def run_config(config_file):
-    """Load data and generate cluster visualization from /config_file/."""
+        rfile.write(''.join(res_lines))
+
+
+def run_config(config_file, shared=None, profile=False, renderer=None):
+    """
+    Load data and generate cluster visualization from /config_file/. Topic
+    models and documents are reused from and added to /shared/ if given.
+    If /profile/ is set, the time and memory used by each stage are logged
+    and written to a report, see write_profile. The chart is saved by the
+    /renderer/ of visualize_clusters.
+    """
     config = ConfigParser.ConfigParser(DEFAULTS)
     config.read(config_file)
 
     #TODO figure out what has (not) to be done from the config file
 
-    #we just start with loading a topic model
-    tm = load_topic_model(config)
-    if not tm:
-        LOG.info('aborting, error in {config}'.format(config=config_file))
-        return
-
     #set title for the clustering
     if config.has_option('clustering', 'title'):
         clustering_title = config.get('clustering', 'title')
     else:
         clustering_title = os.path.basename(config_file)
 
-    if config.has_option('clustering', 'clusterfile'):
-        #load clustering
-        clusters = load_clustering(config, clustering_title)
-        docnames = []
-        for cluster in clusters.itervalues():
-            for doc in cluster:
-                docnames.append(doc)
-
-        #create document representation with the tm for files in the clustering
-        documents = represent_documents_from_files(config, tm, docnames)
+    stages = Profile.Profile(config_file)
+    try:
+        #we just start with loading a topic model
+        with stages.stage('load_topic_model') as counts:
+            tm = load_topic_model(config, shared)
+            if tm:
+                counts.update(words=len(tm.vocab), topics=len(tm))
+        if not tm:
+            LOG.info('aborting, error in {config}'.format(config=config_file))
+            return
+
+        if config.has_option('clustering', 'clusterfile'):
+            #load clustering
+            with stages.stage('load_clustering') as counts:
+                clusters, docnames = load_clustering(config, clustering_title)
+                counts.update(clusters=len(clusters), documents=len(docnames))
+
+            #create document representation with the tm for files in the clustering
+            with stages.stage('represent_documents') as counts:
+                documents = represent_documents_from_files(config, tm,
+                        docnames, shared)
+                counts.update(documents.counts, documents=len(documents))
 
+        else:
+            #update the clustering while representing documents if possible
+            clusterer = create_streaming_clusterer(config)
+
+            #create document representation with the tm
+            with stages.stage('represent_documents') as counts:
+                documents = represent_documents(config, tm, shared, clusterer)
+                counts.update(documents.counts, documents=len(documents))
+
+            #update a previous clustering
+            with stages.stage('update_clustering') as counts:
+                clusters, centers = update_clustering(documents, config,
+                        clustering_title)
+                if clusters is not None:
+                    counts.update(clusters=len(clusters))
+
+            #cluster using custom algorithm
+            if clusters is None:
+                LOG.info('no clustering given, will create clustering myself..')
+                #clustering_title += '_' + config.get('clustering','cluster_algorithm')
+                with stages.stage('create_clustering') as counts:
+                    clusters = create_clustering(documents, config, clusterer)
+                    counts.update(clusters=len(clusters))
+            with stages.stage('save_clustering'):
+                save_clustering(config, clusters, documents, centers)
+
+        if len(clusters) == 0:
+            LOG.info('no clusters for "{title}" found; aborting..'.format(
+                title=clustering_title))
+            return
+
+        #represent clusters with their centroids
+        with stages.stage('create_cluster_centroids', clusters=len(clusters)):
+            cluster_centroids = create_cluster_centroids(clusters, documents,
+                    config.get('clustering', 'cluster_centroid'))
+
+        #export to semeval format
+        with stages.stage('export_to_semeval_format'):
+            export_to_semeval_format(config, documents)
+
+        #visualize clusters
+        with stages.stage('visualize_clusters', clusters=len(clusters)):
+            visualize_clusters(config, tm, clustering_title, cluster_centroids,
+                    renderer)
+    finally:
+        if profile:
+            write_profile(config, config_file, clustering_title, stages)
+
+
+def write_profile(config, config_file, clustering_title, stages):
+    """
+    Logs the measured /stages/ of a run and writes them as JSON to
+    {title}.profile.json in the res_dir of the visualization, or next to the
+    config file if there is none.
+    """
+    LOG.info('profile of "{title}":\n{summary}'.format(title=clustering_title,
+        summary=stages.summary()))
+    if config.has_option('visualization', 'res_dir'):
+        res_dir = config.get('visualization', 'res_dir')
     else:
-        #create document representation with the tm
-        documents = represent_documents(config, tm)
-
-        #cluster using custom algorithm
-        LOG.info('no clustering given, will create clustering myself..')
-        #clustering_title += '_' + config.get('clustering','cluster_algorithm')
-        clusters = create_clustering(documents, config)
-
-    if len(clusters) == 0:
-        LOG.info('no clusters for "{title}" found; aborting..'.format(
-            title=clustering_title))
+        res_dir = os.path.dirname(os.path.abspath(config_file))
+    profile_file = os.path.join(res_dir, '{title}.profile.json'.format(
+        title=clustering_title))
+    try:
+        stages.write(profile_file)
+    except IOError as e:
+        LOG.error('could not write profile: {err}'.format(err=e))
+
+
+def run_configs(config_files, jobs=1, profile=False, render_jobs=0,
+        render_queue=None):
+    """
+    Runs all /config_files/, sharing topic models and documents between
+    them. With more than one job the configs are distributed over a process
+    pool; each process keeps its own shared data. /profile/ is passed on to
+    run_config. Otherwise the charts can be saved by /render_jobs/
+    background processes while the next config is processed, with at most
+    /render_queue/ charts waiting, see Visualize.ChartPool.
+    """
+    #TODO remove semeval file if it exists
+    if jobs <= 1:
+        shared = SharedData()
+        renderer = None
+        if render_jobs > 0:
+            #start before loading any data, the processes are forked
+            renderer = Visualize.ChartPool(render_jobs, render_queue)
+        try:
+            for config_file in config_files:
+                run_config(config_file, shared, profile, renderer)
+        finally:
+            if renderer is not None:
+                renderer.close()
+            #free the figures kept for the radar charts
+            Visualize.RENDERER.close()
         return
+    if render_jobs > 0:
+        LOG.info('charts are saved by the config processes, ignoring '
+                '--render-jobs')
 
-    #represent clusters with their centroids
-    cluster_centroids = create_cluster_centroids(clusters, documents)
+    #hand out consecutive configs together, they often use the same files
+    chunk_size = max(1, len(config_files) // (jobs * 4))
+    pool = multiprocessing.Pool(jobs, _init_batch_worker, (profile,))
+    try:
+        for _ in pool.imap(_run_config_worker, config_files, chunk_size):
+            pass
+    finally:
+        pool.close()
+        pool.join()
 
-    #export to semeval format
-    export_to_semeval_format(config, documents)
 
-    #visualize clusters
-    visualize_clusters(config, tm, clustering_title, cluster_centroids)
+#shared data of a worker process of run_configs and whether it profiles
+_worker_shared = None
+_worker_profile = False
 
+def _init_batch_worker(profile=False):
+    global _worker_shared, _worker_profile
+    _worker_shared = SharedData(allow_workers=False)
+    _worker_profile = profile
 
-def run_configs(config_files):
-    #TODO remove semeval file if it exists
-    for config_file in config_files:
-        run_config(config_file)
+
+def _run_config_worker(config_file):
+    run_config(config_file, _worker_shared, _worker_profile)
 
 
 if __name__ == '__main__':
@@ -328,4 +886,5 @@ if __name__ == '__main__':
 
     logging.debug('Working on the following config files: {clist}'.format(
         clist=config_list))
-    run_configs(config_list)
+    run_configs(config_list, options.jobs, options.profile,
+            options.render_jobs, options.render_queue)